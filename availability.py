@@ -0,0 +1,212 @@
+import datetime
+from collections import OrderedDict
+
+
+# Дни аренды от start до end включительно в формате ГГГГ-ММ-ДД
+def date_range(start: str, end: str = None):
+    day = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end or start)
+    days = []
+    while day <= last:
+        days.append(day.strftime("%Y-%m-%d"))
+        day += datetime.timedelta(days=1)
+    return days
+
+
+# Занятость на период — максимум по дням: {название: забронировано в самый загруженный день}
+def peak_usage(days_counts):
+    peak = {}
+    for counts in days_counts:
+        for item, quantity in counts.items():
+            if quantity > peak.get(item, 0):
+                peak[item] = quantity
+    return peak
+
+
+# Счетчики занятости по дням: одна строка на (день, оборудование), бронь на N дней добавляет
+# свои позиции в каждый из N дней. Доступность на период — один проход по первичному ключу.
+# Счетчики старых броней заполняет фоновая миграция вместе с их позициями
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS item_day_usage (
+                    date TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    PRIMARY KEY (date, item)) WITHOUT ROWID''')
+
+
+def add_usage(conn, start: str, end: str, items: dict):
+    conn.executemany(
+        "INSERT INTO item_day_usage (date, item, quantity) VALUES (?, ?, ?) "
+        "ON CONFLICT (date, item) DO UPDATE SET quantity = quantity + excluded.quantity",
+        [(day, item, quantity) for day in date_range(start, end) for item, quantity in items.items()]
+    )
+
+
+def remove_usage(conn, start: str, end: str, items: dict):
+    days = date_range(start, end)
+    conn.executemany(
+        "UPDATE item_day_usage SET quantity = quantity - ? WHERE date = ? AND item = ?",
+        [(quantity, day, item) for day in days for item, quantity in items.items()]
+    )
+    conn.execute("DELETE FROM item_day_usage WHERE date BETWEEN ? AND ? AND quantity <= 0", (days[0], days[-1]))
+
+
+# Пиковая занятость за период одним запросом: {название: максимум по дням}
+def range_usage(conn, start: str, end: str, items=None):
+    sql = "SELECT item, MAX(quantity) FROM item_day_usage WHERE date BETWEEN ? AND ?"
+    params = [start, end or start]
+    if items:
+        sql += f" AND item IN ({', '.join('?' * len(items))})"
+        params.extend(items)
+    return dict(conn.execute(sql + " GROUP BY item", params).fetchall())
+
+
+# Кэш занятости оборудования по датам: {дата: {название: забронировано}}
+class AvailabilityCache:
+    def __init__(self, max_dates: int = 366, near_days: int = 30):
+        self.max_dates = max_dates
+        # Даты в пределах near_days от сегодняшнего дня вытесняются в последнюю очередь
+        self.near_days = near_days
+        self._dates = OrderedDict()
+        # Номера записей по датам, в том числе по датам не из кэша: загрузка из базы, начатая до записи,
+        # не должна положить в кэш снимок без нее
+        self._write_count = 0
+        self._writes = {}
+        self._cleared = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, date: str):
+        counts = self._dates.get(date)
+        if counts is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._dates.move_to_end(date)
+        return dict(counts)
+
+    # Номер последней записи; загрузка запоминает его до запроса в базу и передает в put(since=...)
+    def write_mark(self):
+        return self._write_count
+
+    def _written(self, date: str):
+        self._write_count += 1
+        self._writes[date] = self._write_count
+
+    def put(self, date: str, counts: dict, since: int = None):
+        # Пока шла загрузка, дату изменили: снимок устарел, дата загрузится заново при следующем обращении
+        if since is not None and max(self._writes.get(date, 0), self._cleared) > since:
+            return
+        self._dates[date] = dict(counts)
+        self._dates.move_to_end(date)
+        while len(self._dates) > self.max_dates:
+            self._evict()
+
+    # Инкрементальное обновление после подтверждения брони
+    def add(self, date: str, items: dict):
+        self._written(date)
+        counts = self._dates.get(date)
+        if counts is None:
+            return
+        for item, quantity in items.items():
+            counts[item] = counts.get(item, 0) + quantity
+
+    # Инкрементальное обновление после удаления брони
+    def remove(self, date: str, items: dict):
+        self._written(date)
+        counts = self._dates.get(date)
+        if counts is None:
+            return
+        for item, quantity in items.items():
+            left = counts.get(item, 0) - quantity
+            if left > 0:
+                counts[item] = left
+            else:
+                counts.pop(item, None)
+
+    def invalidate(self, date: str):
+        self._written(date)
+        self._dates.pop(date, None)
+
+    # Убираем даты, ушедшие в архив
+    def drop_before(self, date: str):
+        for cached in [d for d in self._dates if d < date]:
+            del self._dates[cached]
+        for written in [d for d in self._writes if d < date]:
+            del self._writes[written]
+
+    def clear(self):
+        self._write_count += 1
+        self._cleared = self._write_count
+        self._writes.clear()
+        self._dates.clear()
+
+    def _evict(self):
+        # Сначала вытесняем давно не использованные далекие даты, затем обычный LRU
+        horizon = (datetime.date.today() + datetime.timedelta(days=self.near_days)).strftime("%Y-%m-%d")
+        victim = next((d for d in self._dates if d > horizon), None)
+        if victim is None:
+            victim = next(iter(self._dates))
+        del self._dates[victim]
+        self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "dates": len(self._dates),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+# Занятость за месяц: матрица дни × позиции каталога, строится по одной выборке из item_day_usage.
+# booked[d][i] — забронировано позиции i в день d, free[d][i] — сколько еще свободно
+class MonthMatrix:
+    def __init__(self, year: int, month: int, catalog_items, rows):
+        self.year = year
+        self.month = month
+        self.items = list(catalog_items)
+        self.days = month_days(year, month)
+        item_index = {item.name: i for i, item in enumerate(self.items)}
+        day_index = {day: d for d, day in enumerate(self.days)}
+        self.booked = [[0] * len(self.items) for _ in self.days]
+        for day, item, quantity in rows:
+            if day in day_index and item in item_index:
+                self.booked[day_index[day]][item_index[item]] = quantity
+        stock = [item.stock for item in self.items]
+        self.free = [[max(s - b, 0) for s, b in zip(stock, row)] for row in self.booked]
+        self.total_stock = sum(stock)
+
+    def index(self, name: str):
+        return next((i for i, item in enumerate(self.items) if item.name == name), None)
+
+    # "free" — ничего не занято, "full" — свободного не осталось, иначе "partial".
+    # Без item — по всему каталогу, с item — по одной позиции (индекс в self.items)
+    def status(self, day: int, item: int = None):
+        if item is None:
+            booked, free = sum(self.booked[day]), sum(self.free[day])
+        else:
+            booked, free = self.booked[day][item], self.free[day][item]
+        if not booked:
+            return "free"
+        return "full" if not free else "partial"
+
+    # Дни месяца, в которые позиция свободна хотя бы в количестве quantity
+    def free_days(self, item: int, quantity: int = 1):
+        return [day for day, row in zip(self.days, self.free) if row[item] >= quantity]
+
+
+def month_days(year: int, month: int):
+    first = datetime.date(year, month, 1)
+    last = (first + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+    return date_range(first.strftime("%Y-%m-%d"), last.strftime("%Y-%m-%d"))
+
+
+def month_usage(conn, year: int, month: int):
+    days = month_days(year, month)
+    return conn.execute(
+        "SELECT date, item, quantity FROM item_day_usage WHERE date BETWEEN ? AND ?", (days[0], days[-1])
+    ).fetchall()
@@ -0,0 +1,290 @@
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.base import BaseSession
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+from aiogram_calendar import SimpleCalendarCallback
+
+import bot
+
+
+# Нагрузочный тест бота без доступа к Telegram: настоящий диспетчер, синтетические апдейты,
+# фиктивная сессия Bot вместо HTTP. Пример:
+#   python bench.py --users 2000 --output bench.json
+#   python bench.py --users 500 --contention    — все бронируют одно и то же на одну дату
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 3)
+
+    return {
+        "count": len(values),
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": round(values[-1] * 1000, 3),
+        "mean_ms": round(statistics.fmean(values) * 1000, 3),
+    }
+
+
+# Сессия Bot, которая отвечает на все методы локально и считает вызовы
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}  # {метод: количество}
+        self.last_markup = {}  # {chat_id: последняя inline-клавиатура}
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = getattr(method, "chat_id", None)
+        markup = getattr(method, "reply_markup", None)
+        if chat_id is not None and markup is not None and hasattr(markup, "inline_keyboard"):
+            self.last_markup[chat_id] = markup
+        if method.__returning__ is Message:
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=getattr(method, "text", None),
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def total(self):
+        return sum(self.calls.values())
+
+
+# Время работы каждого обработчика
+class HandlerTimer(BaseMiddleware):
+    def __init__(self):
+        self.timings = {}
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            name = data["handler"].callback.__name__
+            self.timings.setdefault(name, []).append(time.perf_counter() - started)
+
+
+# Счетчик SQL-запросов (служебные BEGIN/COMMIT/SAVEPOINT/PRAGMA не считаются)
+class QueryCounter:
+    SERVICE = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE", "PRAGMA")
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, sql: str):
+        if not sql.lstrip().upper().startswith(self.SERVICE):
+            self.count += 1
+
+
+class Simulator:
+    def __init__(self, app: bot.App, session: FakeSession, days: int, contention: bool, cancel_share: float,
+                 max_rental: int = 1):
+        self.app = app
+        self.session = session
+        self.days = days
+        self.contention = contention
+        self.cancel_share = cancel_share
+        self.max_rental = max_rental
+        self.ids = itertools.count(1)
+        self.update_latency = {}  # {шаг: [секунды]}
+        self.errors = 0
+
+    def _user(self, user_id: int):
+        return User(id=user_id, is_bot=False, first_name=f"user{user_id}", username=f"user{user_id}")
+
+    def message(self, user_id: int, text: str):
+        return Update(update_id=next(self.ids), message=Message(
+            message_id=next(self.ids), date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type="private"), from_user=self._user(user_id), text=text,
+        ))
+
+    def callback(self, user_id: int, data: str):
+        message = Message(message_id=next(self.ids), date=datetime.datetime.now(), chat=Chat(id=user_id, type="private"), text="-")
+        return Update(update_id=next(self.ids), callback_query=CallbackQuery(
+            id=str(next(self.ids)), from_user=self._user(user_id), chat_instance=str(user_id), message=message, data=data,
+        ))
+
+    async def feed(self, step: str, update: Update):
+        started = time.perf_counter()
+        try:
+            await self.app.dp.feed_update(self.app.bot, update)
+        except Exception:
+            self.errors += 1
+        self.update_latency.setdefault(step, []).append(time.perf_counter() - started)
+
+    # Полный сценарий одного пользователя: /start → начало и конец аренды → категория → оборудование → подтверждение → (удаление)
+    async def flow(self, user_id: int, rng: random.Random):
+        date = datetime.date.today() + datetime.timedelta(days=1 if self.contention else rng.randint(1, self.days))
+        end_date = date + datetime.timedelta(days=0 if self.contention else rng.randint(0, self.max_rental - 1))
+        categories = list(self.app.catalog.categories)
+        category = categories[0] if self.contention else rng.choice(categories)
+        items = self.app.catalog.categories[category]
+
+        await self.feed("start", self.message(user_id, "/start"))
+        await self.feed("start_booking", self.message(user_id, "Забронировать оборудование"))
+        await self.feed("calendar", self.callback(user_id, SimpleCalendarCallback(
+            act="DAY", year=date.year, month=date.month, day=date.day).pack()))
+        if end_date == date:
+            await self.feed("end_date", self.message(user_id, "Один день"))
+        else:
+            await self.feed("end_date", self.callback(user_id, SimpleCalendarCallback(
+                act="DAY", year=end_date.year, month=end_date.month, day=end_date.day).pack()))
+        await self.feed("category", self.message(user_id, category))
+        picked = items[:1] if self.contention else rng.sample(items, k=min(len(items), rng.randint(1, 3)))
+        for item in picked:
+            for _ in range(1 if self.contention else rng.randint(1, 2)):
+                await self.feed("cart_inc", self.callback(user_id, bot.CartCallback(action="inc", item_id=item.id).pack()))
+        await self.feed("cart_done", self.callback(user_id, bot.CartCallback(action="done").pack()))
+        await self.feed("confirm", self.message(user_id, "Подтвердить бронь"))
+        await self.feed("my_bookings", self.message(user_id, "Мои бронирования"))
+
+        if rng.random() < self.cancel_share:
+            await self.feed("start_deleting", self.message(user_id, "Удалить бронь"))
+            markup = self.session.last_markup.get(user_id)
+            buttons = [b.callback_data for row in markup.inline_keyboard for b in row] if markup else []
+            delete = next((data for data in buttons if data and data.startswith("delete_booking:")), None)
+            if delete:
+                await self.feed("delete", self.callback(user_id, delete))
+
+
+# Проверка, что ни на одну дату не забронировано больше, чем есть в наличии.
+# Занятость считается заново по самим броням и сверяется со счетчиками по дням
+async def find_overbooking(app: bot.App):
+    rows = await app.db.fetchall(
+        "SELECT b.date, b.end_date, bi.item, bi.quantity FROM bookings b "
+        "JOIN booking_items bi ON bi.booking_id = b.rowid "
+        # Удержания листа ожидания тоже учитываются в счетчиках
+        "UNION ALL SELECT date, end_date, item, quantity FROM waitlist WHERE held_until IS NOT NULL"
+    )
+    usage = {}
+    for start, end, item, quantity in rows:
+        for day in bot.date_range(start, end):
+            usage[(day, item)] = usage.get((day, item), 0) + quantity
+    counters = {(day, item): quantity for day, item, quantity in await app.db.fetchall(
+        "SELECT date, item, quantity FROM item_day_usage"
+    )}
+    overbooked = []
+    for (date, item), quantity in sorted(usage.items()):
+        catalog_item = app.catalog.get(item)
+        if catalog_item and quantity > catalog_item.stock:
+            overbooked.append({"date": date, "item": item, "booked": quantity, "stock": catalog_item.stock})
+    if counters != usage:
+        overbooked.append({"error": "счетчики item_day_usage расходятся с бронями"})
+    return overbooked
+
+
+async def run(args):
+    session = FakeSession(latency=args.api_latency / 1000)
+    # Токен фиктивный, база во временном каталоге (удаляется после прогона, а при ошибке — при выходе)
+    tempdir = tempfile.TemporaryDirectory(prefix="bookings-bench-")
+    app = bot.create_app(bot.Config(
+        token="123456:BENCHMARK",
+        db_path=os.path.join(tempdir.name, "bookings.db"),
+        warm_days=args.days,
+        metrics_log_interval=0,
+    ), session=session)
+    counter = QueryCounter()
+    app.db.trace = counter
+    timer = HandlerTimer()
+    app.dp.message.middleware(timer)
+    app.dp.callback_query.middleware(timer)
+    # Симулированные пользователи действуют быстрее живых, ограничение частоты им не нужно
+    app.throttling.rate = app.throttling.burst = 10 ** 6
+
+    started = time.perf_counter()
+    await app.dp.emit_startup(bot=app.bot)
+    startup = time.perf_counter() - started
+    simulator = Simulator(app, session, args.days, args.contention, args.cancel_share, args.max_rental)
+    slots = asyncio.Semaphore(args.concurrency or args.users)
+
+    async def user(user_id):
+        async with slots:
+            await simulator.flow(user_id, random.Random(args.seed + user_id))
+
+    queries_before, calls_before = counter.count, session.total()
+    started = time.perf_counter()
+    await asyncio.gather(*(user(1000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    queries, calls = counter.count - queries_before, session.total() - calls_before
+    updates = sum(len(v) for v in simulator.update_latency.values())
+
+    confirmed = (await app.db.fetchone("SELECT COUNT(*) FROM bookings"))[0]
+    overbooked = await find_overbooking(app)
+    await app.dp.emit_shutdown(bot=app.bot)
+    tempdir.cleanup()
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "params": vars(args),
+        "startup_ms": round(startup * 1000, 1),
+        "elapsed_s": round(elapsed, 3),
+        "updates": updates,
+        "updates_per_s": round(updates / elapsed, 1) if elapsed else None,
+        "errors": simulator.errors,
+        "handlers": {name: percentiles(values) for name, values in sorted(timer.timings.items())},
+        "steps": {name: percentiles(values) for name, values in simulator.update_latency.items()},
+        "api_calls": dict(session.calls),
+        "api_calls_per_flow": round(calls / args.users, 2),
+        "db_queries": queries,
+        "db_queries_per_update": round(queries / updates, 2) if updates else None,
+        "availability_cache": app.availability_cache.stats(),
+        "bookings_confirmed": confirmed,
+        "overbooked": overbooked,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на синтетических апдейтах")
+    parser.add_argument("--users", type=int, default=1000, help="количество симулированных пользователей")
+    parser.add_argument("--concurrency", type=int, default=0, help="сколько пользователей действуют одновременно (0 — все)")
+    parser.add_argument("--days", type=int, default=30, help="на сколько дней вперед распределяются брони")
+    parser.add_argument("--max-rental", type=int, default=3, help="максимальная длительность аренды, дней")
+    parser.add_argument("--cancel-share", type=float, default=0.2, help="доля пользователей, отменяющих бронь")
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа Telegram API, мс")
+    parser.add_argument("--contention", action="store_true", help="все бронируют одну позицию на одну дату")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="файл для результатов в JSON (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Результаты сохранены в {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    if result["overbooked"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
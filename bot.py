@@ -1,85 +1,100 @@
 import logging
 import asyncio
 import datetime
-import sqlite3
-from aiogram import Bot, Dispatcher, types
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, CallbackQuery
-from aiogram.fsm.storage.memory import MemoryStorage
+import time
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, CallbackQuery, InlineKeyboardButton, FSInputFile
 from aiogram.fsm.context import FSMContext
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject, StateFilter
 from aiogram.fsm.state import StatesGroup, State
 from aiogram_calendar import SimpleCalendar, SimpleCalendarCallback
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.filters.callback_data import CallbackData
+from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 import os
+from typing import NamedTuple, Optional
+from availability import AvailabilityCache, MonthMatrix, date_range, peak_usage
+import availability
+from catalog import Catalog
+from changes import ChangeFeed
+import migrations
+import rollups
+import export
+import waitlist
+from db import Database
+from fsm_storage import SQLiteStorage
+from notifications import NotificationQueue
+from render_cache import RenderCache
+from throttling import ThrottlingMiddleware
+from metrics import (Metrics, HandlerMetricsMiddleware, TelegramMetricsMiddleware, InstrumentedConnection,
+                     start_metrics_server, log_metrics_periodically, summary as metrics_summary)
+from webhook import run_webhook
 
-# Загружаем переменные из .env
-load_dotenv()
+# ID чата для уведомлений (замените на ваш)
+NOTIFICATION_CHAT_ID = "-1002534379051"
 
-# Получаем токен
-TOKEN = os.getenv("TOKEN")
+# Настройки приложения. Импорт модуля ничего не читает и не открывает: настройки из окружения (.env)
+# собирает Config.from_env(), а создание бота и подключение к базе откладываются до запуска
+class Config(NamedTuple):
+    token: str
+    db_path: str = "bookings.db"
+    # Администраторы бота, им доступны команды /stats, /utilization, /revenue, /top и /export
+    admin_ids: frozenset = frozenset()
+    notification_chat_id: str = NOTIFICATION_CHAT_ID
+    fsm_ttl: float = 7 * 24 * 3600
+    # Номер воркера и их количество задает supervisor.py
+    worker_id: int = 0
+    workers: int = 1
+    # На сколько дней вперед прогревать кэш занятости при запуске (0 — не прогревать)
+    warm_days: int = 30
+    # Сколько минут освободившееся оборудование удерживается за первым в листе ожидания
+    hold_minutes: int = 30
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 0  # 0 — HTTP-эндпоинт метрик не запускается
+    metrics_log_interval: float = 600
 
-if not TOKEN:
-    print("Токен не найден в .env!")
-else:
-    print("Токен загружен:", TOKEN)
-logging.basicConfig(level=logging.INFO)
-bot = Bot(token=TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+    @classmethod
+    def from_env(cls):
+        return cls(
+            token=os.getenv("TOKEN"),
+            db_path=os.getenv("DB_PATH", "bookings.db"),
+            # ID через запятую
+            admin_ids=frozenset(int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()),
+            fsm_ttl=float(os.getenv("FSM_TTL", 7 * 24 * 3600)),
+            worker_id=int(os.getenv("WORKER_ID", 0)),
+            workers=int(os.getenv("WORKERS", 1)),
+            warm_days=int(os.getenv("WARM_DAYS", 30)),
+            hold_minutes=int(os.getenv("HOLD_MINUTES", 30)),
+            metrics_host=os.getenv("METRICS_HOST", "127.0.0.1"),
+            metrics_port=int(os.getenv("METRICS_PORT", 0)),
+            metrics_log_interval=float(os.getenv("METRICS_LOG_INTERVAL", 600)),
+        )
 
-# ID чата для уведомлений (замените на ваш)
-NOTIFICATION_CHAT_ID = "-1002534379051"
+# Отчеты ходят в базу, поэтому делят одно ведро и обновляются не чаще раза в пару секунд
+REPORT_THROTTLING = {"throttling": {"key": "reports", "rate": 0.5, "burst": 3}}
 
-# Подключение к базе данных
-conn = sqlite3.connect("bookings.db", check_same_thread=False)
-cursor = conn.cursor()
-
-# Создаем таблицу для бронирований
-cursor.execute('''CREATE TABLE IF NOT EXISTS bookings (
-                    user_id INTEGER,
-                    username TEXT,
-                    date TEXT,
-                    equipment TEXT,
-                    quantity INTEGER,
-                    price INTEGER)''')
-
-# Создаем таблицу для архива
-cursor.execute('''CREATE TABLE IF NOT EXISTS archive_bookings (
-                    user_id INTEGER,
-                    username TEXT,
-                    date TEXT,
-                    equipment TEXT,
-                    quantity INTEGER,
-                    price INTEGER)''')
-conn.commit()
-
-# Словарь с оборудованием (обновленный)
-EQUIPMENT = {
-    "Приборы": {
-        "1200x": [1, 6000], "700x": [2, 3500], "600c": [1, 3500], "400x": [2, 2500], "80c": [2, 1200], "60x": [3, 900], "F22c": [3, 2100],
-         "INFINIBAR 12": [3, 1050], "INFINIBAR 6": [1, 810], "Pipe 4": [1, 3500], "Pipe 42": [1, 5500], "INFINIMAT 4": [1, 3000], "MC Pro": [2, 600], "B7c bulb": [1, 250], "Dedolight": [1, 300]
-    },
-    "Софтбоксы, Насадки": {
-        "Lightdome 150": [1, 750], "Lightdome 90": [2, 600], "Lantern 90": [1, 600], "Fresnel CF10": [2, 700], "Fresnel F10": [1, 600], "Fresnel 2x": [2, 300], "Spotlight 26/19": [1, 900], "Spotlight 80с": [1, 800], "соты INFINIBAR 12": [2, 300], "софтбокс INFINIBAR 12": [2, 600], "соты INFINIBAR 6": [1, 210], "софтбокс INFINIBAR 6": [1, 450], "Lantern F22": [1, 390], "Софт для МС": [1, 150], "Рефлекторы 1200": [1,810], "Softbox 60x": [3, 300]
-    },
-    "Железо, Grip": {
-    "C-stand 40": [5, 300], "A100": [1, 500], "Штатив карандаш": [3, 100], "Джуниор Бум": [1, 500], "Мини Бум": [1, 300], "Рама 8х8": [1, 400], "Мачелини": [3, 100], "Мэджик арм": [1, 150], "Супер клэмп": [1, 60], "Фал 30м": [2, 100], "Фал 20м": [2, 100], "Apple box 20/10": [2, 30], "Страховка 50см по 5шт": [2, 100], "Бабкина сумка": [1, 1]
-    },
-    "Коммутация, Генератор, Дым": {
-        "Кабло 10м по 5шт": [2, 750], "Кабло 10м по 1шт": [5, 150], "5ти яйцевый": [3, 90], "V-mount": [3, 360], "Дым машина": [1, 1000], "Генератор 8кв": [1, 7500], "Генератор 2кв": [1, 3000]
-    },
-    "Связь": {  # Новая категория
-        "Интеркомы 6шт": [1, 5000], "Интеркомы 4шт": [1, 3300], "Интеркомы 2шт": [1, 1650], "Рации": [2, 100]  # Новое оборудование
-    },
-    "Текстиль, Плоскота.": {
-  "Фрост рама 40": [2, 100], "Флоппи 40": [1, 100], "Пена 1х1": [1, 100], "UB 8x8": [1, 250], "S/B 8x8": [1, 250], "Автопол/Тбон 8": [1, 150], "Отражатель": [1, 100]
-    }
-}
+# Максимальная длительность аренды, дней
+MAX_RENTAL_DAYS = 31
+
+# Сколько заявок в листе ожидания может быть у одного пользователя
+MAX_WAITLIST_ENTRIES = 10
+
+# Обработчики бота; диспетчер каждого экземпляра приложения подключает свою копию этого роутера
+router = Router()
+
+# Роутер можно подключить только к одному диспетчеру, а приложений в одном процессе может быть
+# несколько (тесты, bench), поэтому каждое получает копию с теми же обработчиками
+def copy_router(source: Router):
+    copy = Router(name=source.name)
+    for name, observer in source.observers.items():
+        copy.observers[name].handlers.extend(observer.handlers)
+    return copy
 
 # Состояния для FSM
 class BookingState(StatesGroup):
     choosing_date = State()
+    choosing_end_date = State()
     choosing_category = State()
     choosing_items = State()
     confirmation = State()
@@ -101,44 +116,400 @@ main_menu_keyboard = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
-# Функция для отправки уведомлений в чат
-async def send_notification_to_chat(message: str):
-    try:
-        await bot.send_message(chat_id=NOTIFICATION_CHAT_ID, text=message, parse_mode="Markdown")
-    except Exception as e:
-        logging.error(f"Не удалось отправить уведомление в чат: {e}")
+# Период аренды из данных FSM (у старых корзин есть только date)
+def rental_period(data: dict):
+    return data["date"], data.get("end_date") or data["date"]
 
-# Функция для переноса прошедших бронирований в архив
-async def move_past_bookings_to_archive():
-    current_date = datetime.date.today().strftime("%Y-%m-%d")
-    
-    # Выбираем прошедшие бронирования
-    cursor.execute("SELECT * FROM bookings WHERE date < ?", (current_date,))
-    past_bookings = cursor.fetchall()
-    
-    if past_bookings:
-        # Переносим их в архив
-        cursor.executemany("INSERT INTO archive_bookings VALUES (?, ?, ?, ?, ?, ?)", past_bookings)
-        conn.commit()
-        
-        # Удаляем из основной таблицы
-        cursor.execute("DELETE FROM bookings WHERE date < ?", (current_date,))
-        conn.commit()
+def format_period(date: str, end_date: str = None):
+    return date if not end_date or end_date == date else f"{date} — {end_date}"
+
+class ReservationConflict(Exception):
+    def __init__(self, shortages: dict, booked_items: dict):
+        super().__init__(f"Недостаточно оборудования: {shortages}")
+        self.shortages = shortages  # {название: сколько еще доступно}
+        self.booked_items = booked_items  # актуальная занятость на период
+
+# Проверка остатков и запись брони; выполняется в транзакции писателя (BEGIN IMMEDIATE),
+# поэтому между проверкой и вставкой никто другой записать не может — в том числе другие воркеры,
+# работающие с тем же файлом базы
+def reserve_booking(conn, catalog: Catalog, user_id, username, date, end_date, items: dict, equipment: str, price: int):
+    booked_items = availability.range_usage(conn, date, end_date, list(items))
+    shortages = {}
+    for item, quantity in items.items():
+        catalog_item = catalog.get(item)
+        stock = catalog_item.stock if catalog_item else 0
+        available = stock - booked_items.get(item, 0)
+        if quantity > available:
+            shortages[item] = max(available, 0)
+    if shortages:
+        raise ReservationConflict(shortages, booked_items)
+
+    booking_id = insert_booking(conn, user_id, username, date, end_date, items, equipment, price)
+    availability.add_usage(conn, date, end_date, items)
+    return booking_id
+
+# Запись брони и ее позиций без счетчиков занятости (их ведет вызывающий)
+def insert_booking(conn, user_id, username, date, end_date, items: dict, equipment: str, price: int):
+    booking_id = conn.execute(
+        "INSERT INTO bookings (user_id, username, date, end_date, equipment, quantity, price) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, username, date, end_date, equipment, sum(items.values()), price)
+    ).lastrowid
+    conn.executemany(
+        "INSERT INTO booking_items (booking_id, item, quantity) VALUES (?, ?, ?)",
+        [(booking_id, item, quantity) for item, quantity in items.items()]
+    )
+    return booking_id
+
+# Приложение одного воркера: бот, диспетчер, база, кэши и фоновые задачи. Обработчики получают его
+# параметром app. При запуске через supervisor.py воркеров несколько, апдейты одного пользователя
+# всегда попадают в один воркер, а общие остатки проверяются в общей базе
+class App:
+    def __init__(self, config: Config, session=None):
+        self.config = config
+        self.admin_ids = config.admin_ids
+        self.notification_chat_id = config.notification_chat_id
+        self.worker_id = config.worker_id
+        self.workers = config.workers
+        # Архивация, фоновые миграции и отправка уведомлений идут только в первом воркере
+        self.primary = config.worker_id == 0
+        # Бот создается при первом обращении (Bot проверяет токен)
+        self._bot = None
+        self._session = session
+
+        # База данных; соединения открываются при запуске
+        self.db = Database(config.db_path)
+
+        # Состояния и корзины пользователей хранятся в базе и переживают перезапуск
+        self.storage = SQLiteStorage(self.db, ttl=config.fsm_ttl)
+        self.dp = Dispatcher(storage=self.storage)
+        self.dp["app"] = self
+        self.dp.include_router(copy_router(router))
+
+        # Очередь уведомлений в групповой чат; с несколькими воркерами отправитель сам проверяет,
+        # не добавили ли уведомления другие процессы
+        self.notifications = NotificationQueue(self.db, poll_interval=5 if self.workers > 1 else None)
+
+        # Журнал изменений бронирований, по которому воркеры сбрасывают кэши друг друга
+        self.changes = ChangeFeed(self.db, self.worker_id, enabled=self.workers > 1)
+
+        # Ограничение частоты нажатий от одного пользователя
+        self.throttling = ThrottlingMiddleware()
+        self.dp.message.middleware(self.throttling)
+        self.dp.callback_query.middleware(self.throttling)
+
+        # Кэш занятости по датам, чтобы не ходить в базу на каждое нажатие кнопки
+        self.availability_cache = AvailabilityCache()
+        # Загрузки занятости, которые уже идут: одновременные промахи по тем же дням ждут один запрос
+        self._usage_loads = {}
+
+        # Каталог оборудования (таблица equipment), перечитывается при изменениях
+        self.catalog = Catalog()
+
+        # Готовые тексты отчетов и клавиатуры; версия данных увеличивается при каждой записи бронирований
+        self.render_cache = RenderCache()
+
+        # Время, на которое освободившееся оборудование удерживается за заявкой из листа ожидания
+        self.hold_seconds = config.hold_minutes * 60
+
+        # Метрики: время обработчиков, SQL-запросов и запросов к Telegram
+        self.metrics = Metrics()
+        handler_metrics = HandlerMetricsMiddleware(self.metrics)
+        self.dp.message.middleware(handler_metrics)
+        self.dp.callback_query.middleware(handler_metrics)
+        self.db.wrap_connection = lambda conn: InstrumentedConnection(conn, self.metrics)
+        self.metrics.register_gauges("bot_availability_cache", lambda: self.availability_cache.stats())
+        self.metrics.register_gauges("bot_render_cache", lambda: self.render_cache.stats())
+        self.metrics.register_gauges("bot_throttling", lambda: self.throttling.stats())
+        self.metrics.register_gauges("bot_notifications", lambda: {
+            "sent": self.notifications.sent, "failed": self.notifications.failed
+        })
+        self.metrics.register_gauges("bot_changes", lambda: {"received": self.changes.received})
+
+        # Устанавливается, когда фоновые миграции завершены
+        self.migrations_done = asyncio.Event()
+
+        # Выгрузки идут по одной, чтобы не занимать все потоки чтения базы
+        self.export_lock = asyncio.Lock()
+
+        # Фоновые задачи, запущенные при старте
+        self.background_tasks = []
+        self.metrics_runners = []
+
+        self.dp.startup.register(self.on_startup)
+        self.dp.shutdown.register(self.on_shutdown)
+
+    @property
+    def bot(self):
+        if self._bot is None:
+            self._bot = Bot(token=self.config.token, session=self._session)
+        return self._bot
+
+    # Уведомление в чат сохраняется в очередь, а отправляет его фоновая задача, не задерживая ответ пользователю
+    async def notify(self, message: str):
+        await self.notifications.enqueue(self.notification_chat_id, message)
+
+    # Занятость по дням за период одним запросом: {дата: {название: количество}}, в том числе пустые дни
+    async def _load_usage(self, date_from: str, date_to: str):
+        loaded = {day: {} for day in date_range(date_from, date_to)}
+        rows = await self.db.fetchall(
+            "SELECT date, item, quantity FROM item_day_usage WHERE date BETWEEN ? AND ?", (date_from, date_to)
+        )
+        for day, item, quantity in rows:
+            if day in loaded:
+                loaded[day][item] = quantity
+        return loaded
+
+    # Количество забронированного оборудования на дату или период {название: количество}.
+    # Для периода берется самый загруженный день; недостающие в кэше дни читаются одним запросом
+    async def get_booked_items(self, date: str, end_date: str = None):
+        days = {day: self.availability_cache.get(day) for day in date_range(date, end_date)}
+        missing = [day for day, counts in days.items() if counts is None]
+        if missing:
+            # Пользователи, одновременно открывшие один и тот же холодный период, ждут общий запрос
+            key = (missing[0], missing[-1])
+            if key not in self._usage_loads:
+                # Номер записи до запроса: дни, измененные во время загрузки, в кэш не попадут
+                load = asyncio.ensure_future(self._load_usage(*key))
+                self._usage_loads[key] = (load, self.availability_cache.write_mark())
+                load.add_done_callback(lambda _: self._usage_loads.pop(key, None))
+            load, since = self._usage_loads[key]
+            loaded = await asyncio.shield(load)
+            for day in missing:
+                self.availability_cache.put(day, loaded[day], since=since)
+                days[day] = loaded[day]
+        return peak_usage(days.values())
+
+    # Прогрев перед приемом апдейтов: занятость на days дней вперед загружается одним запросом,
+    # и первые пользователи получают ответы из кэша
+    async def warm_up(self, days: int):
+        started = time.perf_counter()
+        today = datetime.date.today()
+        loaded = await self._load_usage(
+            today.strftime("%Y-%m-%d"), (today + datetime.timedelta(days=days - 1)).strftime("%Y-%m-%d")
+        )
+        for day, counts in loaded.items():
+            self.availability_cache.put(day, counts)
+        self.metrics.observe("bot_job_seconds", time.perf_counter() - started, job="warm_up")
+        logging.info(f"Кэш занятости прогрет на {days} дн.")
+
+    def bookings_changed(self):
+        self.render_cache.bump()
+
+    # Удержания из листа ожидания учитываются в занятости: снятые освобождают оборудование, новые занимают
+    def holds_changed(self, released=(), granted=()):
+        for entry in released:
+            for day in date_range(entry.date, entry.end_date):
+                self.availability_cache.remove(day, {entry.item: entry.quantity})
+        for entry in granted:
+            for day in date_range(entry.date, entry.end_date):
+                self.availability_cache.add(day, {entry.item: entry.quantity})
+        self.bookings_changed()
+
+    # Бронирования изменил другой воркер: его изменения в наших кэшах не отражены
+    def apply_remote_change(self, date_from: str = None, date_to: str = None):
+        if date_from:
+            for day in date_range(date_from, date_to):
+                self.availability_cache.invalidate(day)
+        self.bookings_changed()
+
+    # Функция для переноса прошедших бронирований (аренда закончилась до сегодняшнего дня) в архив.
+    # Переносит пачками по batch_size: каждая пачка (вставка в архив и удаление) — одна транзакция,
+    # поэтому прерванный перенос можно безопасно повторить
+    async def move_past_bookings_to_archive(self, batch_size: int = 500):
+        current_date = datetime.date.today().strftime("%Y-%m-%d")
+
+        def archive_batch(conn):
+            rowids = [row[0] for row in conn.execute(
+                "SELECT rowid FROM bookings WHERE end_date < ? ORDER BY end_date LIMIT ?", (current_date, batch_size)
+            ).fetchall()]
+            if not rowids:
+                return 0
+            placeholders = ", ".join("?" * len(rowids))
+            # Добавляем завершенные аренды в сводные таблицы аналитики
+            items = {}
+            for booking_id, item, quantity in conn.execute(
+                f"SELECT booking_id, item, quantity FROM booking_items WHERE booking_id IN ({placeholders})", rowids
+            ).fetchall():
+                booking_items = items.setdefault(booking_id, {})
+                booking_items[item] = booking_items.get(item, 0) + quantity
+            rollups.add_bookings(conn, [
+                (user_id, username, date, end_date, price, items.get(rowid, {}))
+                for rowid, user_id, username, date, end_date, price in conn.execute(
+                    f"SELECT rowid, user_id, username, date, end_date, price FROM bookings WHERE rowid IN ({placeholders})",
+                    rowids
+                ).fetchall()
+            ])
+            # Переносим прошедшие бронирования в архив
+            conn.execute(
+                "INSERT INTO archive_bookings (user_id, username, date, end_date, equipment, quantity, price) "
+                "SELECT user_id, username, date, end_date, equipment, quantity, price "
+                f"FROM bookings WHERE rowid IN ({placeholders})",
+                rowids
+            )
+            # Удаляем из основной таблицы вместе с позициями
+            conn.execute(f"DELETE FROM booking_items WHERE booking_id IN ({placeholders})", rowids)
+            conn.execute(f"DELETE FROM bookings WHERE rowid IN ({placeholders})", rowids)
+            # Прошедшие даты в кэшах занятости не нужны, остальным воркерам достаточно обновить отчеты
+            self.changes.log(conn)
+            return len(rowids)
+
+        archived = 0
+        started = time.perf_counter()
+        while True:
+            moved = await self.db.transaction(archive_batch)
+            archived += moved
+            if moved < batch_size:
+                break
+        if archived:
+            self.bookings_changed()
+        # Счетчики прошедших дней и заявки на них больше не нужны
+        await self.db.execute("DELETE FROM item_day_usage WHERE date < ?", (current_date,))
+        await self.db.transaction(lambda conn: waitlist.drop_before(conn, current_date))
+        self.availability_cache.drop_before(current_date)
+        await self.changes.prune()
+        self.metrics.observe("bot_job_seconds", time.perf_counter() - started, job="archive")
+        logging.info(f"Архивировано бронирований: {archived}")
+        return archived
+
+    # Фоновая задача: архивирует при запуске и затем раз в сутки вскоре после полуночи.
+    # Архивация пишет в таблицы, которые перестраивают и заполняют фоновые миграции, поэтому ждет их завершения
+    async def archive_scheduler(self, delay_after_midnight: int = 300):
+        await self.migrations_done.wait()
+        while True:
+            try:
+                await self.move_past_bookings_to_archive()
+            except Exception as e:
+                logging.error(f"Ошибка при переносе бронирований в архив: {e}")
+            now = datetime.datetime.now()
+            next_run = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time()) \
+                + datetime.timedelta(seconds=delay_after_midnight)
+            await asyncio.sleep((next_run - now).total_seconds())
+
+    # Снимает просроченные удержания и передает оборудование следующим в листе ожидания
+    async def expire_holds(self):
+        def expire(conn):
+            released = waitlist.expire(conn)
+            granted = []
+            for entry in released:
+                granted += waitlist.allocate(conn, self.catalog, entry.date, entry.end_date,
+                                             {entry.item: entry.quantity}, self.hold_seconds, MAX_RENTAL_DAYS)
+            for entry in released + granted:
+                self.changes.log(conn, entry.date, entry.end_date)
+            return released, granted
+
+        started = time.perf_counter()
+        released, granted = await self.db.transaction(expire)
+        if not released:
+            return
+        self.holds_changed(released, granted)
+        self.metrics.observe("bot_job_seconds", time.perf_counter() - started, job="expire_holds")
+        logging.info(f"Снято просроченных удержаний: {len(released)}, передано дальше: {len(granted)}")
+        await send_waitlist_updates(self, granted, expired=released)
+
+    # Фоновая задача: проверка удержаний раз в interval секунд
+    async def hold_scheduler(self, interval: float = 30):
+        while True:
+            try:
+                await self.expire_holds()
+            except Exception as e:
+                logging.error(f"Ошибка при снятии просроченных удержаний: {e}")
+            await asyncio.sleep(interval)
+
+    # Долгие миграции выполняет первый воркер, остальные ждут, пока схема обновится
+    async def run_online_migrations(self):
+        try:
+            if self.primary:
+                await migrations.migrate_online(self.db)
+            else:
+                await migrations.wait_until_migrated(self.db)
+            self.migrations_done.set()
+        except Exception as e:
+            logging.error(f"Ошибка при фоновой миграции схемы: {e}")
+
+    # Запуск бота: общие действия для polling и вебхука
+    async def on_startup(self, bot: Bot):
+        await self.db.connect()
+        await migrations.migrate(self.db)
+        await self.catalog.load(self.db)
+        await self.storage.start()
+        # Уведомления всех воркеров копятся в общей очереди в базе, отправляет их первый воркер
+        await self.notifications.start(bot, deliver=self.primary)
+        await self.changes.start(self.apply_remote_change)
+        if self.config.warm_days:
+            await self.warm_up(self.config.warm_days)
+        if not any(isinstance(m, TelegramMetricsMiddleware) for m in bot.session.middleware):
+            bot.session.middleware(TelegramMetricsMiddleware(self.metrics))
+        self.background_tasks.extend([
+            # Долгие миграции (перестройка таблиц) идут в фоне, бот в это время уже работает
+            asyncio.create_task(self.run_online_migrations()),
+            asyncio.create_task(self.catalog.watch(self.db)),
+        ])
+        if self.primary:
+            self.background_tasks.append(asyncio.create_task(self.archive_scheduler()))
+            self.background_tasks.append(asyncio.create_task(self.hold_scheduler()))
+        if self.config.metrics_port:
+            self.metrics_runners.append(await start_metrics_server(
+                self.metrics, self.config.metrics_host, self.config.metrics_port
+            ))
+        if self.config.metrics_log_interval:
+            self.background_tasks.append(asyncio.create_task(
+                log_metrics_periodically(self.metrics, self.config.metrics_log_interval)
+            ))
+        if self.workers > 1:
+            logging.info(f"Воркер {self.worker_id} из {self.workers} запущен")
+
+    # Завершение работы бота (хранилище FSM диспетчер закрывает раньше, поэтому база еще открыта)
+    async def on_shutdown(self):
+        await self.notifications.stop()
+        await self.changes.stop()
+        for task in self.background_tasks:
+            task.cancel()
+        self.background_tasks.clear()
+        for runner in self.metrics_runners:
+            await runner.cleanup()
+        self.metrics_runners.clear()
+        await self.db.close()
+        logging.info("Закрытие соединения с базой данных")
 
 # Команда /start
-@dp.message(CommandStart())
+@router.message(CommandStart())
 async def start(message: Message, state: FSMContext):
     await message.answer("Привет! Я бот для бронирования оборудования. Используйте кнопки ниже:", reply_markup=main_menu_keyboard)
 
 # Обработка нажатия на кнопку "Забронировать оборудование"
-@dp.message(lambda message: message.text == "Забронировать оборудование")
+@router.message(lambda message: message.text == "Забронировать оборудование")
 async def start_booking(message: Message, state: FSMContext):
     await state.set_state(BookingState.choosing_date)
-    await message.answer("Выберите дату бронирования:", reply_markup=await SimpleCalendar())
+    await message.answer("Выберите дату бронирования:", reply_markup=await SimpleCalendar().start_calendar())
+
+# Клавиатура категорий меняется только вместе с каталогом
+def category_keyboard(app: App):
+    key = ("category_keyboard", app.catalog.version)
+    keyboard = app.render_cache.get(key)
+    if keyboard is None:
+        keyboard = ReplyKeyboardMarkup(
+            keyboard=[[KeyboardButton(text=cat)] for cat in app.catalog.categories] +
+                     [[KeyboardButton(text="Изменить дату"), KeyboardButton(text="Отмена"), KeyboardButton(text="Готово")]],
+            resize_keyboard=True
+        )
+        app.render_cache.put(key, keyboard, static=True)
+    return keyboard
+
+# Переход к выбору категории оборудования
+async def ask_category(app: App, message: Message, state: FSMContext):
+    await state.set_state(BookingState.choosing_category)
+    await message.answer("Выберите категорию оборудования:", reply_markup=category_keyboard(app))
 
-# Обработка выбора даты из календаря
-@dp.callback_query(SimpleCalendarCallback.filter())
-async def process_simple_calendar(callback_query: CallbackQuery, callback_data: dict, state: FSMContext):
+# Клавиатура шага выбора даты окончания
+end_date_keyboard = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text="Один день")], [KeyboardButton(text="Отмена")]],
+    resize_keyboard=True
+)
+
+# Обработка выбора даты из календаря: первая выбранная дата — начало аренды, вторая — окончание
+@router.callback_query(SimpleCalendarCallback.filter())
+async def process_simple_calendar(callback_query: CallbackQuery, callback_data: dict, state: FSMContext, app: App):
     selected, date = await SimpleCalendar().process_selection(callback_query, callback_data)
     if selected:
         # Преобразуем datetime.datetime в datetime.date
@@ -146,55 +517,60 @@ async def process_simple_calendar(callback_query: CallbackQuery, callback_data:
         if selected_date < datetime.date.today():
             await callback_query.message.answer("Ошибка! Нельзя выбрать прошедшую дату.")
             return
-        await state.update_data(date=selected_date.strftime("%Y-%m-%d"))
-        await callback_query.message.answer(f"Вы выбрали дату: {selected_date.strftime('%Y-%m-%d')}")
-        
-        # Устанавливаем состояние выбора категории
-        await state.set_state(BookingState.choosing_category)
-        
-        # Создаем клавиатуру для выбора категории
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=cat)] for cat in EQUIPMENT.keys()] +
-                     [[KeyboardButton(text="Изменить дату"), KeyboardButton(text="Отмена"), KeyboardButton(text="Готово")]],
-            resize_keyboard=True
+
+        if await state.get_state() == BookingState.choosing_end_date.state:
+            start_date = datetime.date.fromisoformat((await state.get_data())["date"])
+            if selected_date < start_date:
+                await callback_query.message.answer("Дата окончания не может быть раньше даты начала.")
+                return
+            if (selected_date - start_date).days >= MAX_RENTAL_DAYS:
+                await callback_query.message.answer(f"Аренда возможна не дольше {MAX_RENTAL_DAYS} дней.")
+                return
+            await state.update_data(end_date=selected_date.strftime("%Y-%m-%d"))
+            await callback_query.message.answer(
+                f"Период аренды: {format_period(start_date.strftime('%Y-%m-%d'), selected_date.strftime('%Y-%m-%d'))} "
+                f"({(selected_date - start_date).days + 1} дн.)"
+            )
+            await ask_category(app, callback_query.message, state)
+            return
+
+        await state.update_data(date=selected_date.strftime("%Y-%m-%d"), end_date=selected_date.strftime("%Y-%m-%d"))
+        await state.set_state(BookingState.choosing_end_date)
+        await callback_query.message.answer(
+            f"Дата начала: {selected_date.strftime('%Y-%m-%d')}. Выберите дату окончания аренды "
+            "или нажмите «Один день».",
+            reply_markup=end_date_keyboard
+        )
+        await callback_query.message.answer(
+            "Дата окончания:",
+            reply_markup=await SimpleCalendar().start_calendar(year=selected_date.year, month=selected_date.month)
         )
-        await callback_query.message.answer("Выберите категорию оборудования:", reply_markup=keyboard)
 
-# Обработка выбора категории
-@dp.message(BookingState.choosing_category)
-async def choose_category(message: Message, state: FSMContext):
-    if message.text in EQUIPMENT:
+# Кнопки на шаге выбора даты окончания
+@router.message(BookingState.choosing_end_date)
+async def choose_end_date(message: Message, state: FSMContext, app: App):
+    if message.text == "Один день":
+        data = await state.get_data()
+        await state.update_data(end_date=data["date"])
+        await message.answer(f"Вы выбрали дату: {data['date']}")
+        await ask_category(app, message, state)
+    elif message.text == "Отмена":
+        await state.clear()
+        await message.answer("Бронирование отменено.", reply_markup=main_menu_keyboard)
+    else:
+        await message.answer("Выберите дату окончания в календаре или нажмите «Один день».")
+
+# Обработка выбора категории (в том числе переключение категории во время выбора оборудования)
+@router.message(StateFilter(BookingState.choosing_category, BookingState.choosing_items))
+async def choose_category(message: Message, state: FSMContext, app: App):
+    if message.text in app.catalog.categories:
         await state.update_data(category=message.text)
+        await state.set_state(BookingState.choosing_items)
         
-        # Получаем выбранную дату
+        # Одно сообщение с редактором корзины, дальше оно только редактируется
         data = await state.get_data()
-        date = data.get("date")
-        
-        # Получаем список забронированного оборудования на эту дату
-        cursor.execute("SELECT equipment FROM bookings WHERE date = ?", (date,))
-        booked_equipment = cursor.fetchall()
-        booked_items = {}
-        for booking in booked_equipment:
-            for item_line in booking[0].split("\n"):
-                if " x" in item_line:
-                    name, quantity = item_line.split(" x")
-                    booked_items[name] = booked_items.get(name, 0) + int(quantity)
-        
-        # Формируем клавиатуру с учетом доступного количества
-        keyboard_buttons = []
-        for item, details in EQUIPMENT[message.text].items():
-            total_available = details[0]  # Общее количество оборудования
-            booked = booked_items.get(item, 0)  # Забронированное количество
-            available = total_available - booked  # Доступное количество
-            keyboard_buttons.append([KeyboardButton(text=f"{item} ({available} шт.)")])
-        
-        # Добавляем кнопки "Назад", "Готово" и "Изменить дату"
-        keyboard_buttons.append([KeyboardButton(text="Назад"), KeyboardButton(text="Готово")])
-        keyboard_buttons.append([KeyboardButton(text="Изменить дату")])
-        
-        keyboard = ReplyKeyboardMarkup(keyboard=keyboard_buttons, resize_keyboard=True)
-        await message.answer("Выберите оборудование:", reply_markup=keyboard)
-        await state.set_state(BookingState.choosing_items)
+        keyboard = await build_cart_keyboard(app, data, app.catalog.categories[message.text])
+        await message.answer(f"Выберите оборудование ({message.text}):", reply_markup=keyboard)
     elif message.text == "Изменить дату":
         await state.set_state(BookingState.choosing_date)
         await message.answer("Выберите дату бронирования:", reply_markup=await SimpleCalendar().start_calendar())
@@ -202,44 +578,47 @@ async def choose_category(message: Message, state: FSMContext):
         await state.clear()
         await message.answer("Бронирование отменено.", reply_markup=main_menu_keyboard)
     elif message.text == "Готово":
-        await show_confirmation(message, state)
+        await show_confirmation(app, message, state)
     else:
         await message.answer("Выберите категорию из списка.")
 
+# Клавиатура для выбора действия со сметой
+confirmation_keyboard = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="Подтвердить бронь")],
+        [KeyboardButton(text="Добавить еще оборудование")],
+        [KeyboardButton(text="Удалить оборудование")],
+        [KeyboardButton(text="Отменить смету")]
+    ],
+    resize_keyboard=True
+)
+
 # Функция для показа подтверждения бронирования
-async def show_confirmation(message: Message, state: FSMContext):
+async def show_confirmation(app: App, message: Message, state: FSMContext):
     data = await state.get_data()
     items = data.get("items", {})
+    date, end_date = rental_period(data)
+    days = len(date_range(date, end_date))
     
-    # Рассчитываем общую стоимость и формируем список выбранного оборудования с ценами
+    # Рассчитываем общую стоимость и формируем список выбранного оборудования с ценами (цена — за день)
     total_price = 0
     user_friendly_details = []
     for item, quantity in items.items():
-        for category, equipment in EQUIPMENT.items():
-            if item in equipment:
-                price_per_unit = equipment[item][1]  # Цена за единицу
-                total_item_price = price_per_unit * quantity  # Общая стоимость для позиции
-                total_price += total_item_price  # Добавляем к общей сумме
-                user_friendly_details.append(f"{item} x{quantity} ({total_item_price} руб.)")
-                break
+        catalog_item = app.catalog.get(item)
+        if catalog_item:
+            total_item_price = catalog_item.price * quantity * days  # Общая стоимость для позиции
+            total_price += total_item_price  # Добавляем к общей сумме
+            user_friendly_details.append(f"{item} x{quantity} ({total_item_price} руб.)")
     
     # Формируем сообщение с выбранным оборудованием и общей стоимостью
     selected_items = "\n".join(user_friendly_details)
     
-    # Создаем клавиатуру для выбора действия
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="Подтвердить бронь")],
-            [KeyboardButton(text="Добавить еще оборудование")],
-            [KeyboardButton(text="Удалить оборудование")],
-            [KeyboardButton(text="Отменить смету")]
-        ],
-        resize_keyboard=True
-    )
+    keyboard = confirmation_keyboard
     
     if items:
         await message.answer(
-            f"Текущий заказ:\n{selected_items}\n\n*Итого: {total_price} руб.*\n\nВыберите действие:",
+            f"Текущий заказ на {format_period(date, end_date)} ({days} дн.):\n{selected_items}\n\n"
+            f"*Итого: {total_price} руб.*\n\nВыберите действие:",
             reply_markup=keyboard,
             parse_mode="Markdown"
         )
@@ -248,223 +627,835 @@ async def show_confirmation(message: Message, state: FSMContext):
     
     await state.set_state(BookingState.confirmation)
 
-# Обработка выбора оборудования
-@dp.message(BookingState.choosing_items)
-async def choose_items(message: Message, state: FSMContext):
+# Кнопки редактора корзины
+class CartCallback(CallbackData, prefix="cart"):
+    action: str  # inc, dec, set, pick, back, done
+    item_id: int = 0
+    quantity: int = 0
+
+# Клавиатура редактора: "−", "название: в заказе/доступно", "+" для каждой позиции.
+# Нажатие на название открывает строку быстрого выбора количества
+async def build_cart_keyboard(app: App, data: dict, catalog_items, picking: int = None):
+    items = data.get("items", {})
+    booked_items = await app.get_booked_items(*rental_period(data))
+    builder = InlineKeyboardBuilder()
+    for catalog_item in catalog_items:
+        quantity = items.get(catalog_item.name, 0)
+        available = max(catalog_item.stock - booked_items.get(catalog_item.name, 0), 0)
+        if catalog_item.id == picking:
+            choices = list(range(min(available, 6) + 1))
+            if available > 6:
+                choices.append(available)
+            builder.row(*[
+                InlineKeyboardButton(
+                    text=f"[{n}]" if n == quantity else str(n),
+                    callback_data=CartCallback(action="set", item_id=catalog_item.id, quantity=n).pack()
+                )
+                for n in choices
+            ])
+        else:
+            builder.row(
+                InlineKeyboardButton(text="−", callback_data=CartCallback(action="dec", item_id=catalog_item.id).pack()),
+                InlineKeyboardButton(
+                    text=f"{catalog_item.name}: {quantity}/{available}",
+                    callback_data=CartCallback(action="pick", item_id=catalog_item.id).pack()
+                ),
+                InlineKeyboardButton(text="+", callback_data=CartCallback(action="inc", item_id=catalog_item.id).pack()),
+            )
+    builder.row(
+        InlineKeyboardButton(text="⬅️ Назад", callback_data=CartCallback(action="back").pack()),
+        InlineKeyboardButton(text="✅ Готово", callback_data=CartCallback(action="done").pack()),
+    )
+    return builder.as_markup()
+
+# Позиции, которые показывает редактор: текущая категория или содержимое корзины
+def editor_items(app: App, data: dict, removing: bool):
+    if removing:
+        return [app.catalog.by_id[item_id] for item_id in data.get("editor_items", []) if item_id in app.catalog.by_id]
+    return app.catalog.categories.get(data.get("category"), [])
+
+# Обработка выбора оборудования: изменения количества редактируют одно и то же сообщение
+@router.callback_query(StateFilter(BookingState.choosing_items, BookingState.removing_items), CartCallback.filter(),
+                   flags={"throttling": {"rate": 5, "burst": 10}})
+async def choose_items(callback_query: CallbackQuery, callback_data: CartCallback, state: FSMContext, app: App):
+    removing = await state.get_state() == BookingState.removing_items.state
     data = await state.get_data()
-    category = data["category"]
     items = data.get("items", {})
-    
-    # Убираем " (X шт.)" для проверки
-    if message.text.split(" (")[0] in EQUIPMENT[category]:
-        item_name = message.text.split(" (")[0]  # Получаем название оборудования без количества
-        date = data["date"]
-        
-        # Получаем список забронированного оборудования на эту дату
-        cursor.execute("SELECT equipment FROM bookings WHERE date = ?", (date,))
-        booked_equipment = cursor.fetchall()
-        booked_items = {}
-        for booking in booked_equipment:
-            for item_line in booking[0].split("\n"):
-                if " x" in item_line:
-                    name, quantity = item_line.split(" x")
-                    booked_items[name] = booked_items.get(name, 0) + int(quantity)
-        
-        # Проверяем доступное количество
-        total_available = EQUIPMENT[category][item_name][0]
-        booked = booked_items.get(item_name, 0)
-        available = total_available - booked
-        
-        # Проверяем, не превышает ли запрошенное количество доступное
-        if available > 0:
-            # Проверяем, сколько уже добавлено в заказ
-            already_added = items.get(item_name, 0)
-            if already_added < available:
-                items[item_name] = already_added + 1
-                await state.update_data(items=items)
-                await message.answer(f"Добавлено: {item_name} ({items[item_name]} шт.)\nОсталось: {available - items[item_name]} шт.")
-            else:
-                await message.answer(f"Невозможно добавить больше {item_name}. Доступно только {available} шт.")
+
+    if callback_data.action == "done":
+        if not items and not removing:
+            await callback_query.answer("Вы не выбрали ни одного оборудования.")
+            return
+        await callback_query.answer()
+        await show_confirmation(app, callback_query.message, state)
+        return
+    if callback_data.action == "back":
+        await callback_query.answer()
+        if removing:
+            await show_confirmation(app, callback_query.message, state)
         else:
-            await message.answer("Это оборудование уже занято на выбранную дату.")
-        
-        # Обновляем клавиатуру с новыми данными
-        keyboard_buttons = []
-        for item, details in EQUIPMENT[category].items():
-            total_available = details[0]
-            booked = booked_items.get(item, 0)
-            available = total_available - booked - items.get(item, 0)  # Учитываем уже добавленное в заказ
-            keyboard_buttons.append([KeyboardButton(text=f"{item} ({available} шт.)")])
-        
-        keyboard_buttons.append([KeyboardButton(text="Назад"), KeyboardButton(text="Готово")])
-        keyboard = ReplyKeyboardMarkup(keyboard=keyboard_buttons, resize_keyboard=True)
-        await message.answer("Выберите оборудование:", reply_markup=keyboard)
-    elif message.text == "Готово":
-        if not items:
-            await message.answer("Вы не выбрали ни одного оборудования.")
+            await ask_category(app, callback_query.message, state)
+        return
+
+    catalog_item = app.catalog.by_id.get(callback_data.item_id)
+    if catalog_item is None:
+        await callback_query.answer("Это оборудование больше недоступно.")
+        return
+
+    # Проверяем доступное количество на выбранный период
+    booked_items = await app.get_booked_items(*rental_period(data))
+    available = max(catalog_item.stock - booked_items.get(catalog_item.name, 0), 0)
+    already_added = items.get(catalog_item.name, 0)
+
+    picking = None
+    notice = None
+    if callback_data.action == "inc":
+        quantity = already_added + 1
+    elif callback_data.action == "dec":
+        quantity = already_added - 1
+    elif callback_data.action == "set":
+        quantity = callback_data.quantity
+    else:  # pick
+        quantity = already_added
+        picking = catalog_item.id
+        notice = f"Выберите количество {catalog_item.name}"
+
+    if quantity > available:
+        # Недостающее количество можно подождать в листе ожидания. Предложение отправляется один раз
+        # на позицию и период, дальше нажатия "+" только показывают подсказку
+        offer_key = f"{catalog_item.id}:{data['date']}:{data.get('end_date')}"
+        offered = data.get("waitlist_offers", [])
+        if callback_data.action == "inc" and offer_key not in offered:
+            await offer_waitlist(app, callback_query.message, catalog_item, *rental_period(data),
+                                 quantity - available, already_added)
+            await state.update_data(waitlist_offers=offered + [offer_key])
+        quantity = min(already_added, available)
+        notice = f"Невозможно добавить больше {catalog_item.name}. Доступно только {available} шт." if available else "Это оборудование уже занято на выбранные даты."
+    quantity = max(quantity, 0)
+
+    if quantity != already_added:
+        if quantity:
+            items[catalog_item.name] = quantity
         else:
-            await show_confirmation(message, state)
-    elif message.text == "Назад":
-        await state.set_state(BookingState.choosing_category)
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=cat)] for cat in EQUIPMENT.keys()] +
-                     [[KeyboardButton(text="Изменить дату"), KeyboardButton(text="Отмена"), KeyboardButton(text="Готово")]],
-            resize_keyboard=True
-        )
-        await message.answer("Выберите категорию оборудования:", reply_markup=keyboard)
-    else:
-        await message.answer("Выберите оборудование из списка или нажмите 'Готово'.")
+            items.pop(catalog_item.name, None)
+        await state.update_data(items=items)
+        data["items"] = items
+
+    if quantity != already_added or callback_data.action in ("pick", "set"):
+        keyboard = await build_cart_keyboard(app, data, editor_items(app, data, removing), picking)
+        try:
+            await callback_query.message.edit_reply_markup(reply_markup=keyboard)
+        except TelegramBadRequest:
+            # Клавиатура не изменилась
+            pass
+    await callback_query.answer(notice or f"{catalog_item.name}: {quantity} шт.")
+
+# Нажатия на кнопки старых сообщений редактора
+@router.callback_query(CartCallback.filter())
+async def stale_cart_callback(callback_query: CallbackQuery):
+    await callback_query.answer("Это сообщение устарело.")
 
 # Обработка подтверждения бронирования
-@dp.message(BookingState.confirmation)
-async def handle_confirmation(message: Message, state: FSMContext):
+@router.message(BookingState.confirmation)
+async def handle_confirmation(message: Message, state: FSMContext, app: App):
     if message.text == "Подтвердить бронь":
-        await confirm_booking(message, state)
+        await confirm_booking(app, message, state)
     elif message.text == "Добавить еще оборудование":
-        await state.set_state(BookingState.choosing_category)
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[[KeyboardButton(text=cat)] for cat in EQUIPMENT.keys()] +
-                     [[KeyboardButton(text="Изменить дату"), KeyboardButton(text="Отмена"), KeyboardButton(text="Готово")]],
-            resize_keyboard=True
-        )
-        await message.answer("Выберите категорию оборудования:", reply_markup=keyboard)
+        await ask_category(app, message, state)
     elif message.text == "Удалить оборудование":
         data = await state.get_data()
         items = data.get("items", {})
         if not items:
             await message.answer("Нет оборудования для удаления.")
         else:
-            keyboard_buttons = []
-            for item, quantity in items.items():
-                keyboard_buttons.append([KeyboardButton(text=f"{item} ({quantity} шт.)")])
-            
-            keyboard_buttons.append([KeyboardButton(text="Назад")])
-            keyboard = ReplyKeyboardMarkup(keyboard=keyboard_buttons, resize_keyboard=True)
-            await message.answer("Выберите оборудование для удаления:", reply_markup=keyboard)
+            # Тот же редактор, но только с позициями из корзины
+            await state.update_data(editor_items=[app.catalog.get(item).id for item in items if app.catalog.get(item)])
             await state.set_state(BookingState.removing_items)
+            data = await state.get_data()
+            keyboard = await build_cart_keyboard(app, data, editor_items(app, data, removing=True))
+            await message.answer("Измените количество или удалите оборудование:", reply_markup=keyboard)
     elif message.text == "Отменить смету":  # Обработка новой кнопки
         await state.clear()
         await message.answer("Смета отменена. Вы вернулись в главное меню.", reply_markup=main_menu_keyboard)
     else:
         await message.answer("Используйте кнопки для выбора действия.")
 
-# Обработка удаления оборудования
-@dp.message(BookingState.removing_items)
-async def remove_items(message: Message, state: FSMContext):
-    data = await state.get_data()
-    items = data.get("items", {})
-    
-    if message.text.split(" (")[0] in items:  # Убираем " (X шт.)" для проверки
-        item_name = message.text.split(" (")[0]  # Получаем название оборудования без количества
-        
-        if items[item_name] > 1:
-            items[item_name] -= 1
-            await state.update_data(items=items)
-            await message.answer(f"Удалено: {item_name} ({items[item_name]} шт.)")
-        else:
-            del items[item_name]
-            await state.update_data(items=items)
-            await message.answer(f"Оборудование {item_name} полностью удалено")
-        
-        # Обновляем клавиатуру с новыми данными
-        keyboard_buttons = []
-        for item, quantity in items.items():
-            keyboard_buttons.append([KeyboardButton(text=f"{item} ({quantity} шт.)")])
-        
-        keyboard_buttons.append([KeyboardButton(text="Назад")])
-        keyboard = ReplyKeyboardMarkup(keyboard=keyboard_buttons, resize_keyboard=True)
-        await message.answer("Выберите оборудование для удаления:", reply_markup=keyboard)
-    elif message.text == "Назад":
-        await show_confirmation(message, state)
+# Обработка сообщений во время удаления оборудования (само удаление идет через редактор корзины)
+@router.message(BookingState.removing_items)
+async def remove_items(message: Message, state: FSMContext, app: App):
+    if message.text == "Назад":
+        await show_confirmation(app, message, state)
+    elif message.text in ("Подтвердить бронь", "Добавить еще оборудование", "Удалить оборудование", "Отменить смету"):
+        await handle_confirmation(message, state, app)
     else:
         await message.answer("Используйте кнопки для выбора оборудования.")
 
-# Обработка нажатия на кнопку "Занятые даты"
-@dp.message(lambda message: message.text == "Занятые даты")
-async def show_booked_dates(message: Message):
-    cursor.execute("SELECT DISTINCT date FROM bookings")
-    dates = cursor.fetchall()
-    if dates:
-        await message.answer("Занятые даты:\n" + "\n".join([date[0] for date in dates]))
+# Кнопки листа ожидания
+class WaitlistCallback(CallbackData, prefix="wait"):
+    action: str  # join — встать в очередь, accept — забронировать удержанное, leave — отказаться или выйти из очереди
+    entry_id: int = 0
+    item_id: int = 0
+    quantity: int = 0
+    in_cart: int = 0  # сколько этой позиции уже в корзине пользователя
+    date: Optional[str] = None  # ГГГГММДД
+    end_date: Optional[str] = None
+
+# Предложение встать в лист ожидания на оборудование, которого не хватает на выбранный период
+async def offer_waitlist(app: App, message: Message, catalog_item, date: str, end_date: str, quantity: int,
+                         in_cart: int = 0):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="🔔 Встать в лист ожидания", callback_data=WaitlistCallback(
+        action="join", item_id=catalog_item.id, quantity=quantity, in_cart=in_cart,
+        date=compact_date(date), end_date=compact_date(end_date)
+    ).pack())
+    await message.answer(
+        f"Не хватает {catalog_item.name} x{quantity} на {format_period(date, end_date)}. "
+        f"Если оборудование освободится, оно будет удержано за вами на {app.config.hold_minutes} мин.",
+        reply_markup=builder.as_markup()
+    )
+
+def hold_keyboard(entry: waitlist.Entry):
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Забронировать", callback_data=WaitlistCallback(action="accept", entry_id=entry.id).pack())
+    builder.button(text="✖️ Отказаться", callback_data=WaitlistCallback(action="leave", entry_id=entry.id).pack())
+    return builder.as_markup()
+
+def format_hold_time(entry: waitlist.Entry):
+    return datetime.datetime.fromtimestamp(entry.held_until).strftime("%H:%M")
+
+# Сообщения участникам листа ожидания: новые удержания с кнопками ответа и истекшие удержания.
+# Пользователь может обслуживаться другим воркером, ответ на кнопки все равно проверяется по базе
+async def send_waitlist_updates(app: App, granted=(), expired=()):
+    messages = [
+        (entry.user_id, f"⌛ Время удержания {entry.item} x{entry.quantity} на "
+                        f"{format_period(entry.date, entry.end_date)} истекло, заявка снята.", None)
+        for entry in expired
+    ] + [
+        (entry.user_id, f"🔔 Освободилось {entry.item} x{entry.quantity} на {format_period(entry.date, entry.end_date)}!\n"
+                        f"Оборудование удержано за вами до {format_hold_time(entry)}.", hold_keyboard(entry))
+        for entry in granted
+    ]
+    for user_id, text, keyboard in messages:
+        try:
+            await app.bot.send_message(user_id, text, reply_markup=keyboard)
+        except Exception as e:
+            logging.warning(f"Не удалось отправить сообщение листа ожидания пользователю {user_id}: {e}")
+
+# Отказ от удержания или выход из очереди; удержанное оборудование сразу предлагается следующим
+async def leave_waitlist(app: App, entry_id: int, user_id: int):
+    def leave(conn):
+        entry = waitlist.remove(conn, entry_id, user_id)
+        granted = []
+        if entry is not None and entry.held_until is not None:
+            granted = waitlist.allocate(conn, app.catalog, entry.date, entry.end_date, {entry.item: entry.quantity},
+                                        app.hold_seconds, MAX_RENTAL_DAYS)
+            for changed in [entry] + granted:
+                app.changes.log(conn, changed.date, changed.end_date)
+        return entry, granted
+
+    entry, granted = await app.db.transaction(leave)
+    if entry is not None and entry.held_until is not None:
+        app.holds_changed([entry], granted)
+        await send_waitlist_updates(app, granted)
+    return entry
+
+# Удержанное оборудование становится бронью; занятость уже учтена удержанием
+async def accept_hold(app: App, callback_query: CallbackQuery, entry_id: int):
+    user = callback_query.from_user
+
+    def accept(conn):
+        entry = waitlist.take(conn, entry_id, user.id)
+        if entry is None:
+            return None
+        catalog_item = app.catalog.get(entry.item)
+        price = catalog_item.price * entry.quantity * len(date_range(entry.date, entry.end_date)) if catalog_item else 0
+        insert_booking(conn, user.id, user.username, entry.date, entry.end_date, {entry.item: entry.quantity},
+                       f"{entry.item} x{entry.quantity}", price)
+        app.changes.log(conn, entry.date, entry.end_date)
+        return entry, price
+
+    result = await app.db.transaction(accept)
+    if result is None:
+        await callback_query.answer("Удержание истекло или уже использовано.", show_alert=True)
+        return
+    entry, price = result
+    app.bookings_changed()
+    period = format_period(entry.date, entry.end_date)
+    await callback_query.message.edit_text(
+        f"Вы забронировали на {period}:\n{entry.item} x{entry.quantity} ({price} руб.)\nИтого: {price} руб."
+    )
+    await callback_query.answer("Бронирование завершено, спасибо!")
+
+    await app.notify(
+        "📢 *Новое бронирование из листа ожидания!*\n\n"
+        f"📅 *Дата:* {period}\n"
+        f"👤 *Пользователь:* @{user.username}\n"
+        f"📦 *Оборудование:*\n{entry.item} x{entry.quantity} ({price} руб.)\n"
+        f"💵 *Итого:* {price} руб.\n\n"
+    )
+
+@router.callback_query(WaitlistCallback.filter())
+async def waitlist_callback(callback_query: CallbackQuery, callback_data: WaitlistCallback, app: App):
+    user = callback_query.from_user
+    if callback_data.action == "accept":
+        await accept_hold(app, callback_query, callback_data.entry_id)
+        return
+    if callback_data.action == "leave":
+        entry = await leave_waitlist(app, callback_data.entry_id, user.id)
+        if entry is None:
+            await callback_query.answer("Заявка уже снята.")
+            return
+        await callback_query.message.edit_text(
+            f"Заявка на {entry.item} x{entry.quantity} ({format_period(entry.date, entry.end_date)}) снята."
+        )
+        await callback_query.answer()
+        return
+
+    # join. Даты приходят из данных кнопки, поэтому период проверяется так же, как при выборе в календаре
+    catalog_item = app.catalog.by_id.get(callback_data.item_id)
+    try:
+        start = datetime.date.fromisoformat(full_date(callback_data.date))
+        end = datetime.date.fromisoformat(full_date(callback_data.end_date))
+    except ValueError:
+        start = end = None
+    if (catalog_item is None or callback_data.quantity < 1 or start is None or start < datetime.date.today()
+            or end < start or (end - start).days >= MAX_RENTAL_DAYS):
+        await callback_query.answer("Это предложение устарело.")
+        return
+    date, end_date = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+    def join(conn):
+        entries = waitlist.user_entries(conn, user.id)
+        if any(e.item == catalog_item.name and (e.date, e.end_date) == (date, end_date) for e in entries):
+            return "Вы уже в листе ожидания на это оборудование."
+        if len(entries) >= MAX_WAITLIST_ENTRIES:
+            return f"В листе ожидания может быть не больше {MAX_WAITLIST_ENTRIES} заявок."
+        # Оборудование могло освободиться, пока пользователь решал; свое в корзине еще не забронировано
+        booked = availability.range_usage(conn, date, end_date, [catalog_item.name]).get(catalog_item.name, 0)
+        if catalog_item.stock - booked - callback_data.in_cart >= callback_data.quantity:
+            return "Оборудование уже свободно, добавьте его в заказ."
+        entry = waitlist.add(conn, user.id, user.username, date, end_date, catalog_item.name, callback_data.quantity)
+        return waitlist.position(conn, entry, MAX_RENTAL_DAYS)
+
+    result = await app.db.transaction(join)
+    if isinstance(result, str):
+        await callback_query.answer(result, show_alert=True)
+        return
+    await callback_query.message.edit_text(
+        f"🔔 Вы в листе ожидания: {catalog_item.name} x{callback_data.quantity} на {format_period(date, end_date)}, "
+        f"место в очереди: {result}.\nКогда оборудование освободится, бот пришлет сообщение. Ваши заявки — /waitlist"
+    )
+    await callback_query.answer()
+
+# Команда /waitlist: заявки пользователя в листе ожидания
+@router.message(Command("waitlist"))
+async def show_waitlist(message: Message, app: App):
+    entries = await app.db.read(lambda conn: waitlist.user_entries(conn, message.from_user.id))
+    if not entries:
+        await message.answer("Вы не стоите в листе ожидания.")
+        return
+    await message.answer("Ваши заявки в листе ожидания:")
+    for entry in entries:
+        text = f"{entry.item} x{entry.quantity} на {format_period(entry.date, entry.end_date)}"
+        if entry.held_until is not None:
+            await message.answer(f"🔔 {text} — удержано за вами до {format_hold_time(entry)}",
+                                 reply_markup=hold_keyboard(entry))
+        else:
+            builder = InlineKeyboardBuilder()
+            builder.button(text="✖️ Выйти из очереди",
+                           callback_data=WaitlistCallback(action="leave", entry_id=entry.id).pack())
+            await message.answer(f"⏳ {text}", reply_markup=builder.as_markup())
+
+MONTH_NAMES = ["Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+               "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь"]
+
+HEATMAP_MARKS = {"free": "🟢", "partial": "🟡", "full": "🔴"}
+
+# Кнопки календаря занятости
+class HeatmapCallback(CallbackData, prefix="heat"):
+    action: str  # "m" — показать месяц, "d" — подробности по дню, "-" — пустая кнопка
+    year: int
+    month: int
+    day: int = 0
+    item_id: int = 0  # 0 — весь каталог
+
+# Матрица занятости за месяц: один запрос вместо поиска по каждому дню
+async def load_month_matrix(app: App, year: int, month: int):
+    rows = await app.db.read(lambda conn: availability.month_usage(conn, year, month))
+    return MonthMatrix(year, month, app.catalog.items.values(), rows)
+
+# Номера дней одной строкой с диапазонами: "3, 5–9, 12"
+def format_days(days):
+    numbers = [int(day[-2:]) for day in days]
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ", ".join(str(a) if a == b else f"{a}–{b}" for a, b in ranges)
+
+# Текст и календарь занятости за месяц: по всему каталогу или по одной позиции
+def render_heatmap(app: App, matrix: MonthMatrix, item_id: int = 0):
+    today = datetime.date.today().strftime("%Y-%m-%d")
+    catalog_item = app.catalog.by_id.get(item_id)
+    item = matrix.index(catalog_item.name) if catalog_item else None
+    item_id = catalog_item.id if catalog_item else 0
+    title = f"{MONTH_NAMES[matrix.month - 1]} {matrix.year}"
+    if item is None:
+        text = f"📅 *Занятость оборудования — {title}*\n"
+    else:
+        free = [day for day in matrix.free_days(item) if day >= today]
+        text = (
+            f"📅 *{catalog_item.name} — {title}*\n"
+            f"Свободно: {format_days(free) if free else 'нет свободных дней'}\n"
+        )
+    text += "🟢 свободно  🟡 занято частично  🔴 занято все\nНажмите на день, чтобы увидеть подробности."
+
+    def button(label, action="-", year=matrix.year, month=matrix.month, day=0):
+        return InlineKeyboardButton(text=label, callback_data=HeatmapCallback(
+            action=action, year=year, month=month, day=day, item_id=item_id
+        ).pack())
+
+    first = datetime.date(matrix.year, matrix.month, 1)
+    prev_month = first - datetime.timedelta(days=1)
+    next_month = first + datetime.timedelta(days=31)
+    builder = InlineKeyboardBuilder()
+    # В прошлые месяцы не листаем: прошедшие дни уже в архиве
+    builder.row(
+        button("‹", "m", prev_month.year, prev_month.month) if first.strftime("%Y-%m") > today[:7] else button(" "),
+        button(title),
+        button("›", "m", next_month.year, next_month.month),
+    )
+    builder.row(*[button(name) for name in ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")])
+    week = [button(" ") for _ in range(first.weekday())]
+    for d, day in enumerate(matrix.days):
+        if day < today:
+            week.append(button(str(d + 1)))
+        else:
+            week.append(button(f"{d + 1}{HEATMAP_MARKS[matrix.status(d, item)]}", "d", day=d + 1))
+        if len(week) == 7:
+            builder.row(*week)
+            week = []
+    if week:
+        builder.row(*week, *[button(" ") for _ in range(7 - len(week))])
+    return text, builder.as_markup()
+
+# Календарь занятости из кэша: зависит от броней, каталога и сегодняшней даты
+async def cached_heatmap(app: App, year: int, month: int, item_id: int = 0):
+    key = ("heatmap", year, month, item_id, app.catalog.version, datetime.date.today())
+
+    async def render():
+        return render_heatmap(app, await load_month_matrix(app, year, month), item_id)
+
+    return await app.render_cache.get_or_render(key, render)
+
+# Обработка нажатия на кнопку "Занятые даты": календарь занятости на текущий месяц
+@router.message(lambda message: message.text == "Занятые даты", flags=REPORT_THROTTLING)
+async def show_booked_dates(message: Message, app: App):
+    today = datetime.date.today()
+    text, keyboard = await cached_heatmap(app, today.year, today.month)
+    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
+
+# Свободные дни позиции за месяц: /free 1200x 2025-03
+@router.message(Command("free"), flags=REPORT_THROTTLING)
+async def show_free_days(message: Message, command: CommandObject, app: App):
+    args = (command.args or "").split()
+    today = datetime.date.today()
+    year, month = today.year, today.month
+    if args and len(args[-1]) == 7 and args[-1][4] == "-":
+        try:
+            parsed = datetime.datetime.strptime(args.pop(), "%Y-%m")
+        except ValueError:
+            await message.answer("Не удалось разобрать месяц. Формат: /free <оборудование> [ГГГГ-ММ]")
+            return
+        year, month = parsed.year, parsed.month
+    name = " ".join(args)
+    if not name:
+        await message.answer("Укажите оборудование: /free <оборудование> [ГГГГ-ММ]")
+        return
+    catalog_item = app.catalog.get(name) or next(
+        (item for item in app.catalog.items.values() if item.name.lower() == name.lower()), None
+    )
+    if catalog_item is None:
+        await message.answer(f"Оборудование «{name}» не найдено.")
+        return
+    text, keyboard = await cached_heatmap(app, year, month, catalog_item.id)
+    await message.answer(text, parse_mode="Markdown", reply_markup=keyboard)
+
+# Листание месяцев и подробности по дню
+@router.callback_query(HeatmapCallback.filter(), flags=REPORT_THROTTLING)
+async def heatmap_callback(callback_query: CallbackQuery, callback_data: HeatmapCallback, app: App):
+    if callback_data.action == "m":
+        await callback_query.answer()
+        text, keyboard = await cached_heatmap(app, callback_data.year, callback_data.month, callback_data.item_id)
+        try:
+            await callback_query.message.edit_text(text, parse_mode="Markdown", reply_markup=keyboard)
+        except TelegramBadRequest:
+            # Месяц не изменился
+            pass
+    elif callback_data.action == "d":
+        day = datetime.date(callback_data.year, callback_data.month, callback_data.day).strftime("%Y-%m-%d")
+        booked_items = await app.get_booked_items(day)
+        catalog_item = app.catalog.by_id.get(callback_data.item_id)
+        if catalog_item:
+            free = max(catalog_item.stock - booked_items.get(catalog_item.name, 0), 0)
+            details = f"{catalog_item.name}: свободно {free} из {catalog_item.stock}"
+        elif booked_items:
+            details = "Занято:\n" + "\n".join(
+                f"{item} {quantity}/{app.catalog.get(item).stock if app.catalog.get(item) else '?'}"
+                for item, quantity in sorted(booked_items.items())
+            )
+        else:
+            details = "Все оборудование свободно."
+        text = f"{day}\n{details}"
+        # Ограничение Telegram на текст всплывающего окна — 200 символов
+        await callback_query.answer(text if len(text) <= 200 else text[:197] + "...", show_alert=True)
     else:
-        await message.answer("Нет занятых дат.")
+        await callback_query.answer()
 
 # Обработка нажатия на кнопку "Мои бронирования"
-@dp.message(lambda message: message.text == "Мои бронирования")
-async def user_report(message: Message):
-    # Переносим прошедшие бронирования в архив
-    await move_past_bookings_to_archive()
-    
-    # Получаем актуальные бронирования
-    cursor.execute("SELECT username, date, price FROM bookings WHERE user_id = ?", (message.from_user.id,))
-    bookings = cursor.fetchall()
-    
-    if bookings:
-        report = "📋 *Ваши бронирования:*\n\n"
+@router.message(lambda message: message.text == "Мои бронирования", flags=REPORT_THROTTLING)
+async def user_report(message: Message, app: App):
+    user_id = message.from_user.id
+
+    # Получаем актуальные бронирования (пустая строка — бронирований нет)
+    async def render():
+        bookings = await app.db.fetchall("SELECT username, date, end_date, price FROM bookings WHERE user_id = ?", (user_id,))
+        report = "📋 *Ваши бронирования:*\n\n" if bookings else ""
         for booking in bookings:
-            username, date, price = booking
+            username, date, end_date, price = booking
             report += (
                 f"👤 *Пользователь:* {username}\n"
-                f"📅 *Дата:* {date}\n"
+                f"📅 *Дата:* {format_period(date, end_date)}\n"
                 f"💵 *Сумма:* {price} руб.\n"
                 "————————————\n"
             )
+        return report
+
+    report = await app.render_cache.get_or_render(("user_report", user_id), render)
+    if report:
         await message.answer(report, parse_mode="Markdown")
     else:
         await message.answer("У вас нет активных бронирований.")
 
-# Обработка нажатия на кнопку "Все бронирования"
-@dp.message(lambda message: message.text == "Все бронирования")
-async def full_report(message: Message):
-    # Переносим прошедшие бронирования в архив
-    await move_past_bookings_to_archive()
-    
-    cursor.execute("SELECT username, date, price FROM bookings")
-    bookings = cursor.fetchall()
-    if bookings:
-        report = "📋 *Все бронирования:*\n\n"
-        for booking in bookings:
-            username, date, price = booking
-            report += (
-                f"👤 *Пользователь:* {username}\n"
-                f"📅 *Дата:* {date}\n"
-                f"💵 *Сумма:* {price} руб.\n"
-                "————————————\n"
+# Количество бронирований на одной странице отчета
+REPORT_PAGE_SIZE = 10
+
+REPORT_TABLES = {"b": "bookings", "a": "archive_bookings"}
+
+# Кнопки листания отчета. Даты хранятся как ГГГГММДД, чтобы уложиться в 64 байта callback_data
+class ReportCallback(CallbackData, prefix="rep"):
+    table: str  # "b" — текущие бронирования, "a" — архив
+    direction: str  # "n" — следующая страница, "p" — предыдущая
+    date: str  # ключ последней/первой строки текущей страницы
+    rowid: int
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    user_id: int = 0
+
+def compact_date(date: str):
+    return date.replace("-", "") if date else None
+
+def full_date(date: str):
+    return f"{date[:4]}-{date[4:6]}-{date[6:]}" if date else ""
+
+# Одна страница отчета: keyset-пагинация по (date, rowid), один запрос по индексу.
+# Возвращает строки страницы и признаки наличия предыдущей/следующей страницы
+async def fetch_report_page(app: App, table: str, date_from: str = "", date_to: str = "", user_id: int = 0,
+                            after=None, before=None, page_size: int = REPORT_PAGE_SIZE):
+    conditions, params = [], []
+    # Период аренды должен пересекаться с периодом фильтра
+    if date_from:
+        conditions.append("end_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("date <= ?")
+        params.append(date_to)
+    if user_id:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if after:
+        conditions.append("(date, rowid) > (?, ?)")
+        params.extend(after)
+    if before:
+        conditions.append("(date, rowid) < (?, ?)")
+        params.extend(before)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = "DESC" if before else "ASC"
+    rows = await app.db.fetchall(
+        f"SELECT rowid, username, date, end_date, price FROM {REPORT_TABLES[table]} {where} "
+        f"ORDER BY date {order}, rowid {order} LIMIT ?",
+        (*params, page_size + 1)
+    )
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before:
+        rows.reverse()
+        return rows, more, True
+    return rows, after is not None, more
+
+# Текст и кнопки страницы отчета
+def render_report_page(title: str, table: str, rows, has_prev: bool, has_next: bool,
+                       date_from: str = "", date_to: str = "", user_id: int = 0):
+    report = f"📋 *{title}:*\n\n"
+    for _, username, date, end_date, price in rows:
+        report += (
+            f"👤 *Пользователь:* {username}\n"
+            f"📅 *Дата:* {format_period(date, end_date)}\n"
+            f"💵 *Сумма:* {price} руб.\n"
+            "————————————\n"
+        )
+    filters = dict(date_from=compact_date(date_from), date_to=compact_date(date_to), user_id=user_id)
+    builder = InlineKeyboardBuilder()
+    if has_prev:
+        first_rowid, _, first_date, _, _ = rows[0]
+        builder.button(text="⬅️ Назад", callback_data=ReportCallback(
+            table=table, direction="p", date=compact_date(first_date), rowid=first_rowid, **filters
+        ))
+    if has_next:
+        last_rowid, _, last_date, _, _ = rows[-1]
+        builder.button(text="Вперед ➡️", callback_data=ReportCallback(
+            table=table, direction="n", date=compact_date(last_date), rowid=last_rowid, **filters
+        ))
+    return report, builder.as_markup() if has_prev or has_next else None
+
+REPORT_TITLES = {"b": "Все бронирования", "a": "Ваши архивные бронирования"}
+
+# Страница отчета из кэша: (текст, клавиатура), для пустой страницы — (None, None)
+async def report_page(app: App, table: str, date_from: str = "", date_to: str = "", user_id: int = 0, after=None, before=None):
+    async def render():
+        rows, has_prev, has_next = await fetch_report_page(app, table, date_from, date_to, user_id, after, before)
+        if not rows:
+            return None, None
+        return render_report_page(REPORT_TITLES[table], table, rows, has_prev, has_next, date_from, date_to, user_id)
+
+    return await app.render_cache.get_or_render(("report", table, date_from, date_to, user_id, after, before), render)
+
+async def send_report(app: App, message: Message, table: str, empty_text: str,
+                      date_from: str = "", date_to: str = "", user_id: int = 0):
+    report, keyboard = await report_page(app, table, date_from, date_to, user_id)
+    if report is None:
+        await message.answer(empty_text)
+        return
+    await message.answer(report, parse_mode="Markdown", reply_markup=keyboard)
+
+# Разбор фильтров команд /report и /archive: [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [@username или user_id]
+async def parse_report_filters(app: App, args: str):
+    date_from, date_to, user_id = "", "", 0
+    for arg in (args or "").split():
+        if arg.startswith("@"):
+            row = await app.db.fetchone(
+                "SELECT user_id FROM bookings WHERE username = ? "
+                "UNION ALL SELECT user_id FROM archive_bookings WHERE username = ? LIMIT 1",
+                (arg[1:], arg[1:])
             )
-        await message.answer(report, parse_mode="Markdown")
-    else:
-        await message.answer("Нет активных бронирований.")
+            if not row:
+                raise ValueError(f"Пользователь {arg} не найден.")
+            user_id = row[0]
+        elif arg.isdigit():
+            user_id = int(arg)
+        else:
+            try:
+                date = datetime.datetime.strptime(arg, "%Y-%m-%d").strftime("%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"Не удалось разобрать «{arg}». Формат: ГГГГ-ММ-ДД ГГГГ-ММ-ДД @username")
+            if not date_from:
+                date_from = date
+            else:
+                date_to = date
+    return date_from, date_to, user_id
+
+# Обработка нажатия на кнопку "Все бронирования"
+@router.message(lambda message: message.text == "Все бронирования", flags=REPORT_THROTTLING)
+async def full_report(message: Message, app: App):
+    await send_report(app, message, "b", "Нет активных бронирований.")
+
+# Все бронирования с фильтрами: /report 2025-03-01 2025-03-31 @username
+@router.message(Command("report"), flags=REPORT_THROTTLING)
+async def filtered_report(message: Message, command: CommandObject, app: App):
+    try:
+        date_from, date_to, user_id = await parse_report_filters(app, command.args)
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+    await send_report(app, message, "b", "Нет бронирований по заданным фильтрам.", date_from, date_to, user_id)
 
 # Обработка нажатия на кнопку "Архив бронирований"
-@dp.message(lambda message: message.text == "Архив бронирований")
-async def show_archive(message: Message):
+@router.message(lambda message: message.text == "Архив бронирований", flags=REPORT_THROTTLING)
+async def show_archive(message: Message, app: App):
     # Получаем архивные бронирования пользователя
-    cursor.execute("SELECT username, date, price FROM archive_bookings WHERE user_id = ?", (message.from_user.id,))
-    archive_bookings = cursor.fetchall()
-    
-    if archive_bookings:
-        report = "📋 *Ваши архивные бронирования:*\n\n"
-        for booking in archive_bookings:
-            username, date, price = booking
-            report += (
-                f"👤 *Пользователь:* {username}\n"
-                f"📅 *Дата:* {date}\n"
-                f"💵 *Сумма:* {price} руб.\n"
-                "————————————\n"
-            )
-        await message.answer(report, parse_mode="Markdown")
-    else:
-        await message.answer("У вас нет архивных бронирований.")
+    await send_report(app, message, "a", "У вас нет архивных бронирований.", user_id=message.from_user.id)
+
+# Архив пользователя за период: /archive 2025-01-01 2025-03-31
+@router.message(Command("archive"), flags=REPORT_THROTTLING)
+async def filtered_archive(message: Message, command: CommandObject, app: App):
+    try:
+        date_from, date_to, _ = await parse_report_filters(app, command.args)
+    except ValueError as e:
+        await message.answer(str(e))
+        return
+    await send_report(app, message, "a", "Нет архивных бронирований за этот период.", date_from, date_to, message.from_user.id)
+
+# Листание отчетов: редактируем то же сообщение
+@router.callback_query(ReportCallback.filter(), flags=REPORT_THROTTLING)
+async def turn_report_page(callback_query: CallbackQuery, callback_data: ReportCallback, app: App):
+    # В архиве пользователь видит только свои бронирования
+    if callback_data.table == "a" and callback_data.user_id != callback_query.from_user.id:
+        await callback_query.answer("Это не ваш отчет.")
+        return
+    cursor = (full_date(callback_data.date), callback_data.rowid)
+    filters = dict(
+        date_from=full_date(callback_data.date_from),
+        date_to=full_date(callback_data.date_to),
+        user_id=callback_data.user_id,
+    )
+    report, keyboard = await report_page(
+        app,
+        callback_data.table,
+        after=cursor if callback_data.direction == "n" else None,
+        before=cursor if callback_data.direction == "p" else None,
+        **filters
+    )
+    await callback_query.answer()
+    if report is None:
+        return
+    try:
+        await callback_query.message.edit_text(report, parse_mode="Markdown", reply_markup=keyboard)
+    except TelegramBadRequest:
+        # Страница не изменилась
+        pass
+
+# Метрики для администраторов
+@router.message(Command("stats"))
+async def show_stats(message: Message, app: App):
+    if message.from_user.id not in app.admin_ids:
+        return
+    await message.answer(metrics_summary(app.metrics))
+
+# Аналитика для администраторов по завершенным арендам (сводные таблицы, без агрегации архива)
+async def check_analytics_access(app: App, message: Message):
+    if message.from_user.id not in app.admin_ids:
+        return False
+    if not app.migrations_done.is_set():
+        await message.answer("Идет обновление базы данных, аналитика появится позже.")
+        return False
+    return True
+
+# Загрузка оборудования за месяц: /utilization 2025-03
+@router.message(Command("utilization"))
+async def show_utilization(message: Message, command: CommandObject, app: App):
+    if not await check_analytics_access(app, message):
+        return
+    month = (command.args or "").strip() or datetime.date.today().strftime("%Y-%m")
+    try:
+        month = datetime.datetime.strptime(month, "%Y-%m").strftime("%Y-%m")
+    except ValueError:
+        await message.answer("Формат: /utilization ГГГГ-ММ")
+        return
+    unit_days = dict(await app.db.fetchall("SELECT item, unit_days FROM rollup_item_month WHERE month = ?", (month,)))
+    if not unit_days:
+        await message.answer(f"За {month} нет завершенных аренд.")
+        return
+    items, categories = rollups.utilization(unit_days, app.catalog.items.values(), month)
+    lines = [f"📊 Загрузка оборудования за {month}", "", "По категориям:"]
+    lines += [f"  {category}: {share:.0%}" for category, share in sorted(categories.items(), key=lambda kv: -kv[1])]
+    lines += ["", "Самые загруженные позиции:"]
+    lines += [
+        f"  {item}: {share:.0%} ({unit_days.get(item, 0)} ед.×дн.)"
+        for item, share in sorted(items.items(), key=lambda kv: -kv[1])[:10] if share
+    ]
+    await message.answer("\n".join(lines))
+
+# Выручка по месяцам: /revenue 12
+@router.message(Command("revenue"))
+async def show_revenue(message: Message, command: CommandObject, app: App):
+    if not await check_analytics_access(app, message):
+        return
+    months = int(command.args) if command.args and command.args.strip().isdigit() else 12
+    rows = await app.db.fetchall("SELECT month, bookings, revenue FROM rollup_month ORDER BY month DESC LIMIT ?", (months,))
+    if not rows:
+        await message.answer("Завершенных аренд пока нет.")
+        return
+    lines = ["💵 Выручка по месяцам (месяц начала аренды):"]
+    lines += [f"  {month}: {revenue} руб., броней: {bookings}" for month, bookings, revenue in rows]
+    lines.append(f"Итого: {sum(row[2] for row in rows)} руб.")
+    await message.answer("\n".join(lines))
+
+# Лучшие клиенты по выручке: /top 10
+@router.message(Command("top"))
+async def show_top_customers(message: Message, command: CommandObject, app: App):
+    if not await check_analytics_access(app, message):
+        return
+    limit = int(command.args) if command.args and command.args.strip().isdigit() else 10
+    rows = await app.db.fetchall(
+        "SELECT user_id, username, bookings, revenue, last_date FROM rollup_customer ORDER BY revenue DESC LIMIT ?",
+        (limit,)
+    )
+    if not rows:
+        await message.answer("Завершенных аренд пока нет.")
+        return
+    lines = ["🏆 Лучшие клиенты:"]
+    lines += [
+        f"  {n}. {'@' + username if username else user_id}: {revenue} руб., броней: {bookings}, последняя: {last_date}"
+        for n, (user_id, username, bookings, revenue, last_date) in enumerate(rows, 1)
+    ]
+    await message.answer("\n".join(lines))
+
+# Ограничение Telegram на размер документа, отправляемого ботом
+MAX_DOCUMENT_SIZE = 50 * 1024 * 1024
+
+EXPORT_SOURCES = {
+    "all": ("bookings", "archive_bookings"),
+    "bookings": ("bookings",),
+    "archive": ("archive_bookings",),
+}
+
+# Выгрузка для бухгалтерии: /export [csv|xlsx] [all|bookings|archive] [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [@username]
+@router.message(Command("export"))
+async def export_bookings(message: Message, command: CommandObject, app: App):
+    if message.from_user.id not in app.admin_ids:
+        return
+    fmt, source, filters = "csv", "all", []
+    for arg in (command.args or "").split():
+        if arg.lower() in export.WRITERS:
+            fmt = arg.lower()
+        elif arg.lower() in EXPORT_SOURCES:
+            source = arg.lower()
+        else:
+            filters.append(arg)
+    try:
+        date_from, date_to, user_id = await parse_report_filters(app, " ".join(filters))
+    except ValueError as e:
+        await message.answer(f"{e}\nКоманда: /export [csv|xlsx] [all|bookings|archive] [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД] [@username]")
+        return
+    if app.export_lock.locked():
+        await message.answer("Выгрузка уже идет, она будет выполнена следующей.")
+
+    async with app.export_lock:
+        started = time.perf_counter()
+        path, count = await app.db.read(lambda conn: export.export_bookings(
+            conn, fmt, EXPORT_SOURCES[source], date_from, date_to, user_id
+        ))
+        try:
+            app.metrics.observe("bot_job_seconds", time.perf_counter() - started, job="export")
+            if not count:
+                await message.answer("Нет бронирований по заданным фильтрам.")
+            elif os.path.getsize(path) > MAX_DOCUMENT_SIZE:
+                await message.answer("Файл больше 50 МБ, сузьте период выгрузки.")
+            else:
+                await message.answer_document(
+                    FSInputFile(path, filename=f"bookings_{source}_{datetime.date.today():%Y%m%d}.{fmt}"),
+                    caption=f"Выгружено бронирований: {count}"
+                )
+        finally:
+            os.remove(path)
 
 # Обработка нажатия на кнопку "Удалить бронь"
-@dp.message(lambda message: message.text == "Удалить бронь")
-async def start_deleting_booking(message: Message, state: FSMContext):
-    # Переносим прошедшие бронирования в архив
-    await move_past_bookings_to_archive()
-    
+@router.message(lambda message: message.text == "Удалить бронь")
+async def start_deleting_booking(message: Message, state: FSMContext, app: App):
     # Получаем все актуальные бронирования пользователя
-    cursor.execute("SELECT rowid, date, equipment FROM bookings WHERE user_id = ?", (message.from_user.id,))
-    bookings = cursor.fetchall()
+    bookings = await app.db.fetchall("SELECT rowid, date, end_date, equipment FROM bookings WHERE user_id = ?", (message.from_user.id,))
     
     if not bookings:
         await message.answer("У вас нет активных бронирований.")
@@ -473,14 +1464,14 @@ async def start_deleting_booking(message: Message, state: FSMContext):
     # Создаем клавиатуру с кнопками
     builder = InlineKeyboardBuilder()
     for booking in bookings:
-        rowid, date, equipment = booking
+        rowid, date, end_date, equipment = booking
         # Берем первые несколько позиций оборудования для отображения
         equipment_list = equipment.split("\n")
         short_equipment = ", ".join(equipment_list[:3])  # Показываем первые 3 позиции
         if len(equipment_list) > 3:
             short_equipment += "..."  # Добавляем многоточие, если позиций больше 3
         # Формируем текст кнопки
-        button_text = f"{date} - {short_equipment}"
+        button_text = f"{format_period(date, end_date)} - {short_equipment}"
         # Добавляем кнопку с callback_data, содержащим ID бронирования
         builder.button(text=button_text, callback_data=f"delete_booking:{rowid}")
     builder.adjust(1)  # Располагаем кнопки по одной в строке
@@ -490,107 +1481,150 @@ async def start_deleting_booking(message: Message, state: FSMContext):
     await state.set_state(DeletingBookingState.choosing_booking_to_delete)
 
 # Обработка выбора бронирования для удаления
-@dp.callback_query(DeletingBookingState.choosing_booking_to_delete, lambda c: c.data.startswith("delete_booking:"))
-async def process_booking_deletion(callback_query: CallbackQuery, state: FSMContext):
+@router.callback_query(DeletingBookingState.choosing_booking_to_delete, lambda c: c.data.startswith("delete_booking:"))
+async def process_booking_deletion(callback_query: CallbackQuery, state: FSMContext, app: App):
     # Извлекаем ID бронирования из callback_data
     selected_id = int(callback_query.data.split(":")[1])
     
     # Проверяем, что бронирование принадлежит текущему пользователю
-    cursor.execute("SELECT rowid, date, equipment FROM bookings WHERE rowid = ? AND user_id = ?", (selected_id, callback_query.from_user.id))
-    selected_booking = cursor.fetchone()
+    selected_booking = await app.db.fetchone("SELECT rowid, date, end_date, equipment FROM bookings WHERE rowid = ? AND user_id = ?", (selected_id, callback_query.from_user.id))
     
     if not selected_booking:
         await callback_query.message.answer("Бронирование с таким ID не найдено или оно принадлежит другому пользователю.")
         return
     
-    # Удаляем бронирование из базы данных
-    cursor.execute("DELETE FROM bookings WHERE rowid = ?", (selected_id,))
-    conn.commit()
+    _, date, end_date, equipment = selected_booking
+    
+    # Удаляем бронирование из базы данных вместе со счетчиками занятости по дням. Освободившееся
+    # оборудование в той же транзакции удерживается за первыми подходящими заявками листа ожидания
+    def delete_booking(conn):
+        freed_items = dict(conn.execute("SELECT item, quantity FROM booking_items WHERE booking_id = ?", (selected_id,)).fetchall())
+        conn.execute("DELETE FROM booking_items WHERE booking_id = ?", (selected_id,))
+        holds = []
+        if conn.execute("DELETE FROM bookings WHERE rowid = ?", (selected_id,)).rowcount:
+            availability.remove_usage(conn, date, end_date, freed_items)
+            holds = waitlist.allocate(conn, app.catalog, date, end_date, freed_items, app.hold_seconds,
+                                      MAX_RENTAL_DAYS)
+            for changed in [(date, end_date)] + [(hold.date, hold.end_date) for hold in holds]:
+                app.changes.log(conn, *changed)
+        return freed_items, holds
+
+    freed_items, holds = await app.db.transaction(delete_booking)
+    for day in date_range(date, end_date):
+        app.availability_cache.remove(day, freed_items)
+    app.holds_changed(granted=holds)
     
-    await callback_query.message.answer(f"Бронирование на {selected_booking[1]} успешно удалено!", reply_markup=main_menu_keyboard)
+    await callback_query.message.answer(f"Бронирование на {format_period(date, end_date)} успешно удалено!", reply_markup=main_menu_keyboard)
     await state.clear()
 
     # Уведомление в чат об отмене бронирования
     notification_message = (
         "❌ *Бронирование отменено!*\n\n"
-        f"📅 *Дата:* {selected_booking[1]}\n"
+        f"📅 *Дата:* {format_period(date, end_date)}\n"
         f"👤 *Пользователь:* @{callback_query.from_user.username}\n"
-        f"📦 *Оборудование:* {selected_booking[2]}\n\n"
+        f"📦 *Оборудование:* {equipment}\n\n"
         "Оборудование снова доступно для бронирования! 🎉"
     )
-    await send_notification_to_chat(notification_message)
+    if holds:
+        notification_message += "\n\nУдержано для листа ожидания:\n" + "\n".join(
+            f"{hold.item} x{hold.quantity} ({format_period(hold.date, hold.end_date)})" for hold in holds
+        )
+    await app.notify(notification_message)
+    await send_waitlist_updates(app, holds)
 
 # Подтверждение бронирования
-async def confirm_booking(message: Message, state: FSMContext):
+async def confirm_booking(app: App, message: Message, state: FSMContext):
     data = await state.get_data()
-    date = data["date"]
+    date, end_date = rental_period(data)
+    days = len(date_range(date, end_date))
     items = data.get("items", {})
     
-    # Рассчитываем общую стоимость и формируем данные для сохранения
+    # Рассчитываем общую стоимость (цена — за день) и формируем данные для сохранения и сообщения с ценами
     total_price = 0
     booking_details = []
-    for item, quantity in items.items():
-        for category, equipment in EQUIPMENT.items():
-            if item in equipment:
-                price = equipment[item][1] * quantity
-                total_price += price
-                # Сохраняем оборудование в формате "название xколичество"
-                booking_details.append(f"{item} x{quantity}")
-                break
-    
-    # Сохраняем бронирование в базу данных
-    cursor.execute(
-        "INSERT INTO bookings (user_id, username, date, equipment, quantity, price) VALUES (?, ?, ?, ?, ?, ?)",
-        (message.from_user.id, message.from_user.username, date, "\n".join(booking_details), sum(items.values()), total_price)
-    )
-    conn.commit()
-    
-    # Формируем сообщение с ценами для пользователя
     user_friendly_details = []
     for item, quantity in items.items():
-        for category, equipment in EQUIPMENT.items():
-            if item in equipment:
-                price = equipment[item][1] * quantity
-                user_friendly_details.append(f"{item} x{quantity} ({price} руб.)")
-                break
+        catalog_item = app.catalog.get(item)
+        if catalog_item:
+            price = catalog_item.price * quantity * days
+            total_price += price
+            # Сохраняем оборудование в формате "название xколичество"
+            booking_details.append(f"{item} x{quantity}")
+            user_friendly_details.append(f"{item} x{quantity} ({price} руб.)")
+    
+    # Сохраняем бронирование в базу данных, заново проверяя остатки в той же транзакции
+    def reserve(conn):
+        booking_id = reserve_booking(
+            conn, app.catalog, message.from_user.id, message.from_user.username, date, end_date, items,
+            "\n".join(booking_details), total_price
+        )
+        app.changes.log(conn, date, end_date)
+        return booking_id
+
+    try:
+        await app.db.transaction(reserve)
+    except ReservationConflict as e:
+        # Кто-то успел забронировать раньше: сбрасываем кэш периода и урезаем корзину до остатков
+        for day in date_range(date, end_date):
+            app.availability_cache.invalidate(day)
+        for item, available in e.shortages.items():
+            if available > 0:
+                items[item] = available
+            else:
+                del items[item]
+        await state.update_data(items=items)
+        taken = "\n".join(f"{item} (доступно {available} шт.)" for item, available in e.shortages.items())
+        await message.answer(f"Часть оборудования уже занята на {format_period(date, end_date)}:\n{taken}\n\nЗаказ обновлен.")
+        await show_confirmation(app, message, state)
+        return
+    for day in date_range(date, end_date):
+        app.availability_cache.add(day, items)
+    app.bookings_changed()
     
     # Отправляем сообщение пользователю
-    await message.answer(f"Вы забронировали:\n" + "\n".join(user_friendly_details) + f"\nИтого: {total_price} руб.")
+    await message.answer(f"Вы забронировали на {format_period(date, end_date)}:\n" + "\n".join(user_friendly_details) + f"\nИтого: {total_price} руб.")
     await message.answer("Бронирование завершено, спасибо!", reply_markup=main_menu_keyboard)
     await state.clear()
 
     # Уведомление в чат о новом бронировании
     notification_message = (
         "📢 *Новое бронирование!*\n\n"
-        f"📅 *Дата:* {date}\n"
+        f"📅 *Дата:* {format_period(date, end_date)}\n"
         f"👤 *Пользователь:* @{message.from_user.username}\n"
         f"📦 *Оборудование:*\n" + "\n".join(user_friendly_details) + "\n"
         f"💵 *Итого:* {total_price} руб.\n\n"
     )
-    await send_notification_to_chat(notification_message)
+    await app.notify(notification_message)
 
-# Завершение работы бота
-async def on_shutdown(dp):
-    conn.close()
-    logging.info("Закрытие соединения с базой данных")
+# Фабрика приложения: создание дешевое, база, каталог и бот инициализируются при запуске диспетчера
+def create_app(config: Config, session=None):
+    return App(config, session=session)
 
-# Запуск бота
+# Запуск бота: BOT_MODE=polling (по умолчанию) или webhook
 async def main():
-    await dp.start_polling(bot)
+    config = Config.from_env()
+    if not config.token:
+        logging.error("Токен не найден в .env!")
+        return
+    app = create_app(config)
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        await run_webhook(
+            app.dp, app.bot,
+            host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+            port=int(os.getenv("WEBHOOK_PORT", 8080)),
+            path=os.getenv("WEBHOOK_PATH", "/webhook"),
+            secret=os.getenv("WEBHOOK_SECRET"),
+            url=os.getenv("WEBHOOK_URL"),
+            max_concurrency=int(os.getenv("WEBHOOK_MAX_CONCURRENCY", 100)),
+        )
+    else:
+        await app.dp.start_polling(app.bot)
 
 if __name__ == "__main__":
+    # Загружаем переменные из .env
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
     try:
         asyncio.run(main())
     except Exception as e:
         logging.error(f"Ошибка: {e}")
-    finally:
-        conn.close()
-
-
-
-
-
-
-
-
-
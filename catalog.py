@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from typing import NamedTuple
+
+# Начальный каталог: {категория: {название: [количество, цена]}}.
+# Используется только для заполнения пустой таблицы equipment, дальше каталог живет в базе
+DEFAULT_EQUIPMENT = {
+    "Приборы": {
+        "1200x": [1, 6000], "700x": [2, 3500], "600c": [1, 3500], "400x": [2, 2500], "80c": [2, 1200], "60x": [3, 900], "F22c": [3, 2100],
+         "INFINIBAR 12": [3, 1050], "INFINIBAR 6": [1, 810], "Pipe 4": [1, 3500], "Pipe 42": [1, 5500], "INFINIMAT 4": [1, 3000], "MC Pro": [2, 600], "B7c bulb": [1, 250], "Dedolight": [1, 300]
+    },
+    "Софтбоксы, Насадки": {
+        "Lightdome 150": [1, 750], "Lightdome 90": [2, 600], "Lantern 90": [1, 600], "Fresnel CF10": [2, 700], "Fresnel F10": [1, 600], "Fresnel 2x": [2, 300], "Spotlight 26/19": [1, 900], "Spotlight 80с": [1, 800], "соты INFINIBAR 12": [2, 300], "софтбокс INFINIBAR 12": [2, 600], "соты INFINIBAR 6": [1, 210], "софтбокс INFINIBAR 6": [1, 450], "Lantern F22": [1, 390], "Софт для МС": [1, 150], "Рефлекторы 1200": [1,810], "Softbox 60x": [3, 300]
+    },
+    "Железо, Grip": {
+    "C-stand 40": [5, 300], "A100": [1, 500], "Штатив карандаш": [3, 100], "Джуниор Бум": [1, 500], "Мини Бум": [1, 300], "Рама 8х8": [1, 400], "Мачелини": [3, 100], "Мэджик арм": [1, 150], "Супер клэмп": [1, 60], "Фал 30м": [2, 100], "Фал 20м": [2, 100], "Apple box 20/10": [2, 30], "Страховка 50см по 5шт": [2, 100], "Бабкина сумка": [1, 1]
+    },
+    "Коммутация, Генератор, Дым": {
+        "Кабло 10м по 5шт": [2, 750], "Кабло 10м по 1шт": [5, 150], "5ти яйцевый": [3, 90], "V-mount": [3, 360], "Дым машина": [1, 1000], "Генератор 8кв": [1, 7500], "Генератор 2кв": [1, 3000]
+    },
+    "Связь": {  # Новая категория
+        "Интеркомы 6шт": [1, 5000], "Интеркомы 4шт": [1, 3300], "Интеркомы 2шт": [1, 1650], "Рации": [2, 100]  # Новое оборудование
+    },
+    "Текстиль, Плоскота.": {
+  "Фрост рама 40": [2, 100], "Флоппи 40": [1, 100], "Пена 1х1": [1, 100], "UB 8x8": [1, 250], "S/B 8x8": [1, 250], "Автопол/Тбон 8": [1, 150], "Отражатель": [1, 100]
+    }
+}
+
+
+class CatalogItem(NamedTuple):
+    id: int
+    category: str
+    name: str
+    stock: int
+    price: int
+
+
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS equipment (
+                    id INTEGER PRIMARY KEY,
+                    category TEXT NOT NULL,
+                    name TEXT NOT NULL UNIQUE,
+                    stock INTEGER NOT NULL,
+                    price INTEGER NOT NULL,
+                    position INTEGER NOT NULL DEFAULT 0)''')
+
+    # Версия каталога увеличивается триггерами при любом изменении таблицы equipment
+    conn.execute('''CREATE TABLE IF NOT EXISTS catalog_version (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    version INTEGER NOT NULL)''')
+    conn.execute("INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS equipment_{event.lower()}_version AFTER {event} ON equipment "
+            "BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END"
+        )
+
+    # Брони, счетчики занятости, лист ожидания и сводные таблицы ссылаются на оборудование по названию,
+    # поэтому переименование оторвало бы позицию от ее броней и она показалась бы свободной.
+    # Вместо переименования добавьте новую позицию, а у старой поставьте stock = 0
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS equipment_name_immutable BEFORE UPDATE OF name ON equipment "
+        "WHEN NEW.name IS NOT OLD.name "
+        "BEGIN SELECT RAISE(ABORT, 'Название оборудования изменить нельзя'); END"
+    )
+
+    if conn.execute("SELECT COUNT(*) FROM equipment").fetchone()[0] == 0:
+        rows = []
+        for category, items in DEFAULT_EQUIPMENT.items():
+            for name, (stock, price) in items.items():
+                rows.append((category, name, stock, price, len(rows)))
+        conn.executemany(
+            "INSERT INTO equipment (category, name, stock, price, position) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        logging.info(f"Каталог заполнен начальными данными: {len(rows)} позиций")
+
+
+# Каталог оборудования в памяти: поиск позиции по названию и по id за O(1)
+class Catalog:
+    def __init__(self):
+        self.version = None
+        self.items = {}  # {название: CatalogItem}
+        self.by_id = {}  # {id: CatalogItem}
+        self.categories = {}  # {категория: [CatalogItem, ...]} в порядке отображения
+
+    def get(self, name: str):
+        return self.items.get(name)
+
+    async def load(self, db):
+        version, rows = await db.read(lambda conn: (
+            conn.execute("SELECT version FROM catalog_version WHERE id = 1").fetchone()[0],
+            conn.execute("SELECT id, category, name, stock, price FROM equipment ORDER BY position, id").fetchall()
+        ))
+        items, by_id, categories = {}, {}, {}
+        for row in rows:
+            item = CatalogItem(*row)
+            items[item.name] = item
+            by_id[item.id] = item
+            categories.setdefault(item.category, []).append(item)
+        # Подменяем индексы целиком, чтобы обработчики не видели наполовину загруженный каталог
+        self.items, self.by_id, self.categories = items, by_id, categories
+        self.version = version
+        logging.info(f"Каталог загружен: {len(items)} позиций, версия {version}")
+
+    # Перечитываем каталог, если таблицу equipment изменили (без перезапуска бота)
+    async def watch(self, db, interval: float = 30):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                row = await db.fetchone("SELECT version FROM catalog_version WHERE id = 1")
+                if row and row[0] != self.version:
+                    await self.load(db)
+            except Exception as e:
+                logging.error(f"Не удалось обновить каталог: {e}")
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import time
+
+from db import Database
+
+
+def create_schema(conn):
+    # AUTOINCREMENT: номера не переиспользуются после очистки старых строк
+    conn.execute('''CREATE TABLE IF NOT EXISTS change_log (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    worker INTEGER NOT NULL,
+                    date_from TEXT,
+                    date_to TEXT,
+                    created_at REAL NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_created_at ON change_log (created_at)")
+
+
+# Журнал изменений бронирований для нескольких воркеров (supervisor.py). У каждого воркера свои кэши
+# занятости и отчетов; записывая бронь, воркер добавляет строку в журнал в той же транзакции,
+# а остальные раз в interval секунд читают новые строки и сбрасывают кэши затронутых дат.
+# С одним воркером журнал не ведется. Таблицу создает миграция 3
+class ChangeFeed:
+    def __init__(self, db: Database, worker: int, enabled: bool = True, interval: float = 0.5,
+                 keep: float = 24 * 3600):
+        self.db = db
+        self.worker = worker
+        self.enabled = enabled
+        self.interval = interval
+        self.keep = keep
+        self.received = 0
+        self._on_change = None
+        self._last_id = 0
+        self._task = None
+
+    # on_change(date_from, date_to) вызывается для изменений других воркеров
+    async def start(self, on_change):
+        if not self.enabled:
+            return
+        self._on_change = on_change
+        # Кэши при запуске пустые, поэтому старые изменения не нужны
+        self._last_id = (await self.db.fetchone("SELECT COALESCE(MAX(id), 0) FROM change_log"))[0]
+        if self._task is None:
+            self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    # Вызывается внутри транзакции записи. Без дат — изменились только отчеты (например, при архивации)
+    def log(self, conn, date_from: str = None, date_to: str = None):
+        if self.enabled:
+            conn.execute(
+                "INSERT INTO change_log (worker, date_from, date_to, created_at) VALUES (?, ?, ?, ?)",
+                (self.worker, date_from, date_to, time.time())
+            )
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                rows = await self.db.fetchall(
+                    "SELECT id, worker, date_from, date_to FROM change_log WHERE id > ? ORDER BY id",
+                    (self._last_id,)
+                )
+                for _, worker, date_from, date_to in rows:
+                    if worker != self.worker:
+                        self._on_change(date_from, date_to)
+                        self.received += 1
+                if rows:
+                    self._last_id = rows[-1][0]
+            except Exception as e:
+                logging.error(f"Не удалось прочитать журнал изменений: {e}")
+
+    # Строки старше keep секунд все воркеры уже прочитали
+    async def prune(self):
+        if self.enabled:
+            await self.db.execute("DELETE FROM change_log WHERE created_at < ?", (time.time() - self.keep,))
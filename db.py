@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Асинхронный доступ к SQLite: чтение из пула потоков, запись через одно соединение-писатель.
+# Записи, пришедшие одновременно, выполняются одной транзакцией с одним commit.
+class Database:
+    def __init__(self, path: str, readers: int = 4, max_batch: int = 64):
+        self.path = path
+        self.max_batch = max_batch
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        self._writer_conn = None
+        self._queue = None
+        self._writer_task = None
+        # Необязательный callback, вызывается с текстом каждого выполненного SQL-запроса
+        self.trace = None
+        # Необязательная обертка соединения, которое получают функции чтения и записи (например, для метрик)
+        self.wrap_connection = None
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        conn.execute("PRAGMA busy_timeout = 30000")
+        if self.trace:
+            conn.set_trace_callback(self.trace)
+        return conn
+
+    async def connect(self):
+        if self._writer_task is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._writer_conn = await loop.run_in_executor(self._writer, self._open_writer)
+        self._queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    def _open_writer(self):
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _wrap(self, conn):
+        return self.wrap_connection(conn) if self.wrap_connection else conn
+
+    def _reader_conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    # --- Чтение ---
+
+    async def read(self, fn):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, lambda: fn(self._wrap(self._reader_conn())))
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    # --- Запись ---
+
+    # fn(conn) выполняется в потоке писателя внутри транзакции; результат fn возвращается после commit
+    async def transaction(self, fn):
+        if self._writer_task is None:
+            await self.connect()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, future))
+        return await future
+
+    async def execute(self, sql: str, params=()):
+        return await self.transaction(lambda conn: conn.execute(sql, params).rowcount)
+
+    async def executemany(self, sql: str, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        return await self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount)
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            job = await self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                job = self._queue.get_nowait()
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            try:
+                results = await loop.run_in_executor(self._writer, self._run_batch, [fn for fn, _ in batch])
+            except Exception as e:
+                logging.error(f"Ошибка записи в базу данных: {e}")
+                results = [(False, e)] * len(batch)
+            for (_, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _run_batch(self, fns):
+        conn = self._writer_conn
+        wrapped = self._wrap(conn)
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn in fns:
+                conn.execute("SAVEPOINT job")
+                try:
+                    value = fn(wrapped)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((False, e))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((True, value))
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return results
+
+    async def close(self):
+        if self._writer_task is not None:
+            await self._queue.put(None)
+            await self._writer_task
+            self._writer_task = None
+            await asyncio.get_running_loop().run_in_executor(self._writer, self._writer_conn.close)
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
@@ -0,0 +1,140 @@
+import csv
+import os
+import re
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+
+# Выгрузка бронирований в CSV или XLSX. Строки читаются курсором пачками по chunk_size и сразу
+# пишутся во временный файл, поэтому память не растет с размером архива.
+# Функции синхронные и выполняются в потоке чтения базы (Database.read)
+
+EXPORT_TABLES = {"bookings": "Текущие", "archive_bookings": "Архив"}
+
+HEADER = ["Таблица", "ID", "ID пользователя", "Пользователь", "Начало", "Окончание", "Оборудование", "Количество", "Сумма"]
+
+# Символы, недопустимые в XML
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def iter_rows(conn, tables, date_from: str = "", date_to: str = "", user_id: int = 0, chunk_size: int = 500):
+    conditions, params = [], []
+    # Период аренды должен пересекаться с периодом фильтра
+    if date_from:
+        conditions.append("end_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("date <= ?")
+        params.append(date_to)
+    if user_id:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    for table in tables:
+        cursor = conn.execute(
+            f"SELECT rowid, user_id, username, date, end_date, equipment, quantity, price FROM {table} {where} "
+            "ORDER BY date, rowid",
+            params
+        )
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield (EXPORT_TABLES[table], *row)
+
+
+def write_csv(path: str, rows):
+    count = 0
+    # utf-8-sig и ";" — чтобы файл сразу открывался в русском Excel
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def _xlsx_cell(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f"<c><v>{value}</v></c>"
+    text = escape(_INVALID_XML.sub("", "" if value is None else str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(values):
+    return "<row>" + "".join(_xlsx_cell(value) for value in values) + "</row>"
+
+
+XLSX_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Бронирования" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+
+# Минимальный XLSX без сторонних библиотек: лист пишется в архив потоком, строки — inline-строками
+def write_xlsx(path: str, rows):
+    count = 0
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in XLSX_PARTS.items():
+            archive.writestr(name, content)
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(_xlsx_row(HEADER).encode("utf-8"))
+            for row in rows:
+                sheet.write(_xlsx_row(row).encode("utf-8"))
+                count += 1
+            sheet.write(b"</sheetData></worksheet>")
+    return count
+
+
+WRITERS = {"csv": write_csv, "xlsx": write_xlsx}
+
+
+# Выгружает строки во временный файл; возвращает (путь, количество строк). Файл удаляет вызывающий
+def export_bookings(conn, fmt: str, tables, date_from: str = "", date_to: str = "", user_id: int = 0,
+                    chunk_size: int = 500):
+    fd, path = tempfile.mkstemp(prefix="bookings-export-", suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = WRITERS[fmt](path, iter_rows(conn, tables, date_from, date_to, user_id, chunk_size))
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
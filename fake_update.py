@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+import datetime
+import json
+import random
+
+from aiohttp import ClientSession
+
+from webhook import SECRET_HEADER
+
+
+# Локальный клиент для проверки режима вебхука: отправляет боту поддельный апдейт с сообщением.
+# Пример: python fake_update.py "Все бронирования" --user 123 --secret $WEBHOOK_SECRET
+def build_update(text: str, user_id: int, username: str):
+    return {
+        "update_id": random.randint(1, 2 ** 31),
+        "message": {
+            "message_id": random.randint(1, 2 ** 31),
+            "date": int(datetime.datetime.now().timestamp()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": username, "username": username},
+            "text": text,
+        },
+    }
+
+
+async def send(url: str, text: str, user_id: int, username: str, secret: str = None, count: int = 1):
+    headers = {SECRET_HEADER: secret} if secret else {}
+    async with ClientSession() as session:
+        for _ in range(count):
+            update = build_update(text, user_id, username)
+            async with session.post(url, data=json.dumps(update), headers=headers) as response:
+                print(response.status, update["update_id"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка поддельного апдейта на локальный вебхук")
+    parser.add_argument("text")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--user", type=int, default=1)
+    parser.add_argument("--username", default="tester")
+    parser.add_argument("--secret")
+    parser.add_argument("--count", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(send(args.url, args.text, args.user, args.username, args.secret, args.count))
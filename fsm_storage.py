@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from db import Database
+
+
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS fsm_storage (
+                    key TEXT PRIMARY KEY,
+                    state TEXT,
+                    data TEXT,
+                    updated_at REAL NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated_at ON fsm_storage (updated_at)")
+
+
+# Хранилище FSM в SQLite вместо MemoryStorage.
+# Состояние и данные пользователя держатся в памяти (ограниченный LRU), изменения копятся
+# и записываются одной пачкой раз в flush_interval секунд: set_state и set_data одного апдейта
+# превращаются в одну запись. Сессии, не менявшиеся дольше ttl, удаляются фоновой задачей.
+# Несколько процессов могут работать с одним файлом базы, если апдейты одного пользователя
+# всегда попадают в один процесс (иначе max_cached=0 отключает кэш чистых записей). Таблицу создает миграция 5
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db: Database, ttl: float = 7 * 24 * 3600, max_cached: int = 10000,
+                 flush_interval: float = 0.5, sweep_interval: float = 3600,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.db = db
+        self.ttl = ttl
+        self.max_cached = max_cached
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.key_builder = key_builder or DefaultKeyBuilder()
+        self._entries = OrderedDict()  # {ключ: [state, data, время изменения]}
+        self._dirty = set()
+        self._flush_task = None
+        self._sweep_task = None
+
+    async def start(self):
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def _entry(self, key: StorageKey):
+        storage_key = self.key_builder.build(key)
+        entry = self._entries.get(storage_key)
+        if entry is not None:
+            self._entries.move_to_end(storage_key)
+            return storage_key, entry
+        row = await self.db.fetchone("SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (storage_key,))
+        # Пока шел запрос, запись могла появиться из другой задачи
+        entry = self._entries.get(storage_key)
+        if entry is None:
+            if row and row[2] >= time.time() - self.ttl:
+                entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                entry = [None, {}, time.time()]
+            self._entries[storage_key] = entry
+            self._evict()
+        return storage_key, entry
+
+    def _touch(self, storage_key: str, entry: list):
+        entry[2] = time.time()
+        self._dirty.add(storage_key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    # Вытесняем давно не использованные записи, уже сохраненные в базе
+    def _evict(self):
+        excess = len(self._entries) - len(self._dirty) - self.max_cached
+        if excess <= 0:
+            return
+        for storage_key in list(self._entries):
+            if excess <= 0:
+                break
+            if storage_key not in self._dirty:
+                del self._entries[storage_key]
+                excess -= 1
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(storage_key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key, entry = await self._entry(key)
+        entry[1] = data.copy()
+        self._touch(storage_key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def _delayed_flush(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # Записываем накопленные изменения одной транзакцией
+    async def flush(self):
+        if not self._dirty:
+            return
+        upserts, deletes = [], []
+        for storage_key in self._dirty:
+            entry = self._entries.get(storage_key)
+            if entry is None:
+                continue
+            state, data, updated_at = entry
+            if state is None and not data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, state, json.dumps(data, ensure_ascii=False), updated_at))
+        self._dirty.clear()
+
+        def write(conn):
+            conn.executemany(
+                "INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+                upserts
+            )
+            conn.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+
+        try:
+            await self.db.transaction(write)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояние FSM: {e}")
+            self._dirty.update(key for key, *_ in upserts)
+            self._dirty.update(key for key, in deletes)
+            return
+        self._evict()
+
+    # Удаляем брошенные сессии из базы и из памяти
+    async def sweep(self):
+        expired_before = time.time() - self.ttl
+        for storage_key in [k for k, entry in self._entries.items() if entry[2] < expired_before and k not in self._dirty]:
+            del self._entries[storage_key]
+        removed = await self.db.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (expired_before,))
+        if removed:
+            logging.info(f"Удалено просроченных сессий FSM: {removed}")
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Ошибка при очистке сессий FSM: {e}")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def close(self) -> None:
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Границы корзин гистограмм задержки, секунды
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    # Оценка квантиля по корзинам (верхняя граница корзины)
+    def quantile(self, q: float):
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        seen = 0
+        for i, bound in enumerate(BUCKETS):
+            seen += self.counts[i]
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Реестр метрик: счетчики, гистограммы и значения, которые считываются в момент выгрузки
+class Metrics:
+    def __init__(self):
+        self.counters = {}  # {(имя, метки): значение}
+        self.histograms = {}  # {(имя, метки): Histogram}
+        self._gauges = []  # [(префикс, функция -> {имя: число})]
+        self.started_at = time.time()
+        # Метрики SQL пишутся из потоков пула базы данных
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def register_gauges(self, prefix: str, fn):
+        self._gauges.append((prefix, fn))
+
+    def gauges(self):
+        values = {}
+        for prefix, fn in self._gauges:
+            try:
+                for name, value in fn().items():
+                    if isinstance(value, (int, float)):
+                        values[f"{prefix}_{name}"] = value
+            except Exception as e:
+                logging.error(f"Не удалось получить метрики {prefix}: {e}")
+        return values
+
+    # Выгрузка в текстовом формате Prometheus
+    def render(self):
+        lines = []
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda kv: kv[0])
+        for (name, labels), value in counters:
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{fmt(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{fmt(labels)} {histogram.count}")
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"{name} {value}")
+        lines.append(f"bot_uptime_seconds {time.time() - self.started_at:.0f}")
+        return "\n".join(lines) + "\n"
+
+    # Самые медленные по суммарному времени ряды гистограммы name
+    def top(self, name: str, limit: int = 5):
+        with self._lock:
+            rows = [(dict(labels), h) for (n, labels), h in self.histograms.items() if n == name]
+        rows.sort(key=lambda row: row[1].sum, reverse=True)
+        return rows[:limit]
+
+
+# Время работы обработчиков по имени и состоянию FSM
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        name = data["handler"].callback.__name__
+        state = data.get("raw_state") or "-"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            self.metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name, state=state)
+
+
+# Исходящие запросы к Telegram API: количество, время и ошибки по методам
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            self.metrics.inc("bot_telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            self.metrics.observe("bot_telegram_request_seconds", time.perf_counter() - started, method=name)
+
+
+_IN_LIST = re.compile(r"\(\?(?:,\s*\?)+\)")
+_SPACES = re.compile(r"\s+")
+
+
+# Короткая метка для SQL-запроса: без лишних пробелов и с обобщенными списками IN (?, ?, ...)
+def statement_label(sql: str):
+    sql = _SPACES.sub(" ", _IN_LIST.sub("(?...)", sql)).strip()
+    return sql if len(sql) <= 120 else sql[:117] + "..."
+
+
+# Курсор, который отмечает время и число строк при выборке результата
+class InstrumentedCursor:
+    def __init__(self, cursor, metrics: Metrics, label: str, started: float):
+        self._cursor = cursor
+        self._metrics = metrics
+        self._label = label
+        self._started = started
+
+    def _record(self, rows: int):
+        self._metrics.observe("bot_sql_seconds", time.perf_counter() - self._started, statement=self._label)
+        self._metrics.inc("bot_sql_rows_total", rows, statement=self._label)
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._record(len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._record(1 if row is not None else 0)
+        return row
+
+    def __iter__(self):
+        rows = 0
+        for row in self._cursor:
+            rows += 1
+            yield row
+        self._record(rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+# Обертка над соединением sqlite3: время и число строк каждого запроса
+class InstrumentedConnection:
+    def __init__(self, conn, metrics: Metrics):
+        self._conn = conn
+        self._metrics = metrics
+
+    def execute(self, sql: str, params=()):
+        label = statement_label(sql)
+        started = time.perf_counter()
+        cursor = self._conn.execute(sql, params)
+        if cursor.description is None:
+            # Запрос без результата (INSERT/UPDATE/DELETE/DDL): записываем сразу
+            self._metrics.observe("bot_sql_seconds", time.perf_counter() - started, statement=label)
+            self._metrics.inc("bot_sql_rows_total", max(cursor.rowcount, 0), statement=label)
+            return cursor
+        return InstrumentedCursor(cursor, self._metrics, label, started)
+
+    def executemany(self, sql: str, seq_of_params):
+        label = statement_label(sql)
+        started = time.perf_counter()
+        cursor = self._conn.executemany(sql, seq_of_params)
+        self._metrics.observe("bot_sql_seconds", time.perf_counter() - started, statement=label)
+        self._metrics.inc("bot_sql_rows_total", max(cursor.rowcount, 0), statement=label)
+        return cursor
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+async def start_metrics_server(metrics: Metrics, host: str = "127.0.0.1", port: int = 9100):
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
+
+
+# Короткая сводка для лога и команды /stats
+def summary(metrics: Metrics, limit: int = 5):
+    lines = []
+    handlers = metrics.top("bot_handler_seconds", limit)
+    if handlers:
+        lines.append("Обработчики (всего, вызовов, p95):")
+        for labels, h in handlers:
+            lines.append(f"  {labels['handler']} [{labels['state']}]: {h.sum:.2f} с, {h.count}, ≤{h.quantile(0.95) * 1000:.0f} мс")
+    statements = metrics.top("bot_sql_seconds", limit)
+    if statements:
+        lines.append("SQL (всего, запросов, p95):")
+        for labels, h in statements:
+            lines.append(f"  {labels['statement'][:60]}: {h.sum:.2f} с, {h.count}, ≤{h.quantile(0.95) * 1000:.0f} мс")
+    calls = metrics.top("bot_telegram_request_seconds", limit)
+    if calls:
+        errors = sum(v for (name, _), v in list(metrics.counters.items()) if name == "bot_telegram_errors_total")
+        lines.append(f"Telegram API (ошибок: {errors:.0f}):")
+        for labels, h in calls:
+            lines.append(f"  {labels['method']}: {h.count}, ≤{h.quantile(0.95) * 1000:.0f} мс")
+    for name, value in sorted(metrics.gauges().items()):
+        lines.append(f"{name}: {value}")
+    return "\n".join(lines) or "Метрик пока нет."
+
+
+async def log_metrics_periodically(metrics: Metrics, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("Метрики:\n" + summary(metrics))
@@ -0,0 +1,326 @@
+import asyncio
+import logging
+from typing import Callable, NamedTuple
+
+import availability
+import catalog
+import changes
+import fsm_storage
+import notifications
+import rollups
+import waitlist
+from db import Database
+
+
+# Версионированные миграции схемы. Номер последней примененной миграции хранится в PRAGMA user_version.
+# Обычные миграции выполняются при запуске, каждая в своей транзакции. Онлайн-миграции (перестройка
+# больших таблиц) идут в фоне небольшими пачками, и бот тем временем продолжает работать.
+# migrate() останавливается на первой онлайн-миграции, поэтому все, без чего бот не может принимать
+# апдейты (новые таблицы), должно стоять в списке до онлайн-миграций
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable  # apply(conn) для обычной миграции, async apply(db) для онлайн-миграции
+    online: bool = False
+
+
+# Индексы таблиц бронирований: {таблица: [(имя, столбцы)]}. Создаются миграциями и заново после перестройки
+BOOKING_INDEXES = {
+    "bookings": [
+        ("idx_bookings_date", "date"),
+        ("idx_bookings_user_date", "user_id, date"),  # покрывает и выборку только по user_id
+        ("idx_bookings_end_date", "end_date"),
+        ("idx_bookings_username", "username"),
+    ],
+    "archive_bookings": [
+        ("idx_archive_bookings_date", "date"),
+        ("idx_archive_bookings_user_date", "user_id, date"),
+        ("idx_archive_bookings_username", "username"),
+    ],
+}
+
+BOOKING_COLUMNS = "user_id, username, date, end_date, equipment, quantity, price"
+
+
+def booking_table_sql(table: str):
+    return f'''CREATE TABLE IF NOT EXISTS {table} (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER,
+                    username TEXT,
+                    date TEXT,
+                    end_date TEXT,
+                    equipment TEXT,
+                    quantity INTEGER,
+                    price INTEGER)'''
+
+
+def create_indexes(conn, table: str):
+    for name, columns in BOOKING_INDEXES[table]:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+# Разбор старого текстового поля equipment ("название xколичество" построчно)
+def parse_equipment(equipment: str):
+    items = {}
+    for item_line in equipment.split("\n"):
+        if " x" in item_line:
+            name, quantity = item_line.rsplit(" x", 1)
+            items[name] = items.get(name, 0) + int(quantity)
+    return items
+
+
+# 1. Базовая схема. В новой базе таблицы бронирований сразу создаются с первичным ключом,
+# в старой только добавляются недостающие столбцы; данные старых броней заполняет миграция 7
+def create_base_schema(conn):
+    conn.execute(booking_table_sql("bookings"))
+    conn.execute(booking_table_sql("archive_bookings"))
+
+    # Брони на несколько дней: date — первый день аренды, end_date — последний
+    for table in ("bookings", "archive_bookings"):
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        if "end_date" not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN end_date TEXT")
+
+    # Позиции бронирования: одна строка на каждое оборудование в заказе
+    conn.execute('''CREATE TABLE IF NOT EXISTS booking_items (
+                    booking_id INTEGER,
+                    item TEXT,
+                    quantity INTEGER)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_booking_items_booking ON booking_items (booking_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_booking_items_item ON booking_items (item)")
+
+    # Индексы для выборки по дате и постраничных отчетов по (date, rowid) с фильтром по пользователю
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_user_date ON bookings (user_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bookings_end_date ON bookings (end_date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_bookings_date ON archive_bookings (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_archive_bookings_user_date ON archive_bookings (user_id, date)")
+
+    # Счетчики занятости по дням
+    availability.create_schema(conn)
+    catalog.create_schema(conn)
+
+
+# 2. Индексы для поиска по username (фильтр @username в /report)
+def add_username_indexes(conn):
+    for table in BOOKING_INDEXES:
+        create_indexes(conn, table)
+
+
+# 7. Данные старых броней, пачками по rowid: end_date = date у однодневных броней (в архиве тоже)
+# и позиции booking_items, разобранные из текстового поля equipment, вместе со счетчиками занятости.
+# Новые брони сразу пишутся с позициями и счетчиками и пропускаются, поэтому после перезапуска
+# заполнение можно просто начать сначала. Пока оно идет, старые брони еще не видны в счетчиках
+async def backfill_booking_items(db: Database, batch_size: int = 1000, pause: float = 0.05):
+    def bookings_batch(conn, after: int, until: int):
+        rows = conn.execute(
+            "SELECT rowid, date, end_date, equipment FROM bookings WHERE rowid > ? AND rowid <= ? "
+            "ORDER BY rowid LIMIT ?",
+            (after, until, batch_size)
+        ).fetchall()
+        if not rows:
+            return None, 0
+        conn.execute(
+            "UPDATE bookings SET end_date = date WHERE rowid BETWEEN ? AND ? AND end_date IS NULL",
+            (rows[0][0], rows[-1][0])
+        )
+        with_items = {row[0] for row in conn.execute(
+            "SELECT DISTINCT booking_id FROM booking_items WHERE booking_id BETWEEN ? AND ?",
+            (rows[0][0], rows[-1][0])
+        ).fetchall()}
+        moved = 0
+        for rowid, date, end_date, equipment in rows:
+            if rowid in with_items:
+                continue
+            items = parse_equipment(equipment or "")
+            conn.executemany(
+                "INSERT INTO booking_items (booking_id, item, quantity) VALUES (?, ?, ?)",
+                [(rowid, name, quantity) for name, quantity in items.items()]
+            )
+            availability.add_usage(conn, date, end_date or date, items)
+            moved += 1
+        return rows[-1][0], moved
+
+    def archive_batch(conn, after: int, until: int):
+        last = conn.execute(
+            "SELECT MAX(rowid) FROM (SELECT rowid FROM archive_bookings WHERE rowid > ? AND rowid <= ? "
+            "ORDER BY rowid LIMIT ?)",
+            (after, until, batch_size)
+        ).fetchone()[0]
+        if last is None:
+            return None, 0
+        conn.execute(
+            "UPDATE archive_bookings SET end_date = date WHERE rowid > ? AND rowid <= ? AND end_date IS NULL",
+            (after, last)
+        )
+        return last, 0
+
+    for table, batch in (("bookings", bookings_batch), ("archive_bookings", archive_batch)):
+        # Строки, добавленные после начала заполнения, уже записаны с end_date и позициями
+        until = (await db.fetchone(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}"))[0]
+        moved, after = 0, 0
+        while True:
+            last, count = await db.transaction(lambda conn: batch(conn, after, until))
+            if last is None:
+                break
+            moved, after = moved + count, last
+            # Даем обработчикам пользователей выполнить свои записи между пачками
+            await asyncio.sleep(pause)
+        if moved:
+            logging.info(f"Перенесено бронирований в booking_items: {moved}")
+
+
+# 8–9. Явный первичный ключ id вместо неявного rowid. Таблица перестраивается онлайн:
+# новая таблица заполняется пачками, а триггеры на старой переносят в нее изменения, сделанные
+# за это время. Значения id совпадают со старыми rowid, поэтому ссылки из booking_items сохраняются.
+# Замена таблицы — одна короткая транзакция в конце
+async def rebuild_with_primary_key(db: Database, table: str, batch_size: int = 1000, pause: float = 0.05):
+    def has_primary_key(conn):
+        return any(row[5] for row in conn.execute(f"PRAGMA table_info({table})").fetchall())
+
+    if await db.read(has_primary_key):
+        return
+
+    new_table = f"{table}_rebuild"
+    values = ", ".join(f"NEW.{column.strip()}" for column in BOOKING_COLUMNS.split(","))
+
+    def prepare(conn):
+        # Незавершенная перестройка после перезапуска начинается заново
+        conn.execute(f"DROP TABLE IF EXISTS {new_table}")
+        conn.execute(booking_table_sql(new_table))
+        for event in ("INSERT", "UPDATE"):
+            conn.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {new_table}_{event.lower()} AFTER {event} ON {table} BEGIN "
+                f"INSERT OR REPLACE INTO {new_table} (id, {BOOKING_COLUMNS}) VALUES (NEW.rowid, {values}); END"
+            )
+        conn.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {new_table}_delete AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM {new_table} WHERE id = OLD.rowid; END"
+        )
+        # Строки, добавленные после этого момента, переносят триггеры: пачками копируется только
+        # то, что уже было в таблице, иначе при постоянных вставках копирование не закончилось бы
+        return conn.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {table}").fetchone()[0]
+
+    def copy_batch(conn, after: int, until: int):
+        rowids = [row[0] for row in conn.execute(
+            f"SELECT rowid FROM {table} WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?",
+            (after, until, batch_size)
+        ).fetchall()]
+        if not rowids:
+            return None, 0
+        # Строки, которые уже перенес триггер, не трогаем: в них более свежие данные
+        conn.execute(
+            f"INSERT OR IGNORE INTO {new_table} (id, {BOOKING_COLUMNS}) "
+            f"SELECT rowid, {BOOKING_COLUMNS} FROM {table} WHERE rowid BETWEEN ? AND ?",
+            (rowids[0], rowids[-1])
+        )
+        return rowids[-1], len(rowids)
+
+    def swap(conn):
+        for event in ("insert", "update", "delete"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {new_table}_{event}")
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {new_table} RENAME TO {table}")
+        create_indexes(conn, table)
+
+    until = await db.transaction(prepare)
+    copied, after = 0, 0
+    while True:
+        last, count = await db.transaction(lambda conn: copy_batch(conn, after, until))
+        if last is None:
+            break
+        copied, after = copied + count, last
+        # Даем обработчикам пользователей выполнить свои записи между пачками
+        await asyncio.sleep(pause)
+    await db.transaction(swap)
+    logging.info(f"Таблица {table} перестроена с первичным ключом, перенесено строк: {copied}")
+
+
+# 10. Сводные таблицы аналитики, заполняются по уже накопленному архиву пачками.
+# Архивация в это время не идет (ждет завершения фоновых миграций), поэтому строки не задваиваются
+async def backfill_rollups(db: Database, batch_size: int = 1000, pause: float = 0.05):
+    def prepare(conn):
+        rollups.create_schema(conn)
+        # Незавершенное заполнение после перезапуска начинается заново
+        rollups.clear(conn)
+
+    def add_batch(conn, after: int):
+        rows = conn.execute(
+            "SELECT id, user_id, username, date, end_date, price, equipment FROM archive_bookings "
+            "WHERE id > ? ORDER BY id LIMIT ?", (after, batch_size)
+        ).fetchall()
+        if not rows:
+            return None, 0
+        # Позиции архивных броней хранятся только в текстовом поле equipment
+        rollups.add_bookings(conn, [
+            (user_id, username, date, end_date, price, parse_equipment(equipment or ""))
+            for _, user_id, username, date, end_date, price, equipment in rows
+        ])
+        return rows[-1][0], len(rows)
+
+    await db.transaction(prepare)
+    added, after = 0, 0
+    while True:
+        last, count = await db.transaction(lambda conn: add_batch(conn, after))
+        if last is None:
+            break
+        added, after = added + count, last
+        await asyncio.sleep(pause)
+    logging.info(f"Сводные таблицы заполнены по архиву, броней: {added}")
+
+
+MIGRATIONS = [
+    Migration(1, "Базовая схема", create_base_schema),
+    Migration(2, "Индексы по username", add_username_indexes),
+    Migration(3, "Журнал изменений для нескольких воркеров", changes.create_schema),
+    Migration(4, "Лист ожидания", waitlist.create_schema),
+    Migration(5, "Хранилище состояний FSM", fsm_storage.create_schema),
+    Migration(6, "Очередь уведомлений", notifications.create_schema),
+    Migration(7, "Позиции и end_date старых броней", backfill_booking_items, online=True),
+    Migration(8, "Первичный ключ bookings", lambda db: rebuild_with_primary_key(db, "bookings"), online=True),
+    Migration(9, "Первичный ключ archive_bookings", lambda db: rebuild_with_primary_key(db, "archive_bookings"), online=True),
+    Migration(10, "Сводные таблицы аналитики", backfill_rollups, online=True),
+]
+
+
+async def schema_version(db: Database):
+    return (await db.fetchone("PRAGMA user_version"))[0]
+
+
+async def apply_migration(db: Database, migration: Migration):
+    logging.info(f"Миграция {migration.version}: {migration.description}")
+
+    def set_version(conn):
+        conn.execute(f"PRAGMA user_version = {migration.version}")
+
+    if migration.online:
+        await migration.apply(db)
+        await db.transaction(set_version)
+    else:
+        # Миграция и номер версии фиксируются одной транзакцией
+        await db.transaction(lambda conn: (migration.apply(conn), set_version(conn)))
+
+
+# Обычные миграции до первой онлайн-миграции. Вызывается при запуске до обработки апдейтов
+async def migrate(db: Database):
+    version = await schema_version(db)
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        if migration.online:
+            break
+        await apply_migration(db, migration)
+
+
+# Для воркеров, которые сами онлайн-миграции не запускают: ждем, пока их выполнит первый воркер
+async def wait_until_migrated(db: Database, interval: float = 5):
+    while await schema_version(db) < MIGRATIONS[-1].version:
+        await asyncio.sleep(interval)
+
+
+# Оставшиеся миграции, начиная с первой онлайн-миграции; запускается фоновой задачей
+async def migrate_online(db: Database):
+    version = await schema_version(db)
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            await apply_migration(db, migration)
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from db import Database
+
+# Ограничение Telegram на длину сообщения
+MAX_MESSAGE_LENGTH = 4096
+
+
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS notifications (
+                    id INTEGER PRIMARY KEY,
+                    chat_id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_notifications_next_attempt ON notifications (next_attempt_at)")
+
+
+# Очередь уведомлений в групповой чат. Уведомления сначала сохраняются в базе, затем фоновая
+# задача отправляет их: пачка уведомлений за coalesce_window секунд уходит одной сводкой,
+# retry_after от Telegram соблюдается, остальные ошибки повторяются с экспоненциальной паузой.
+# Отказ Telegram принять текст (TelegramBadRequest, обычно ошибка разметки) повтором не исправить:
+# сводка тогда рассылается по одному уведомлению, а уведомление без разметки; теряется только то,
+# которое не удалось отправить и простым текстом.
+# Если в очередь пишут несколько процессов, отправляет один (deliver=True), а poll_interval
+# ограничивает ожидание: уведомления других процессов не будят его событием. Таблицу создает миграция 6
+class NotificationQueue:
+    def __init__(self, db: Database, coalesce_window: float = 3, max_backoff: float = 600,
+                 max_attempts: int = 10, batch_size: int = 50, poll_interval: float = None):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.coalesce_window = coalesce_window
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.bot = None
+        self.sent = 0
+        self.failed = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    async def start(self, bot: Bot, deliver: bool = True):
+        self.bot = bot
+        if deliver and self._task is None:
+            self._task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def enqueue(self, chat_id, text: str):
+        now = time.time()
+        await self.db.execute(
+            "INSERT INTO notifications (chat_id, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+            (str(chat_id), text, now, now)
+        )
+        self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            try:
+                if not await self._deliver_ready():
+                    await self._wait_for_work()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка в очереди уведомлений: {e}")
+                await asyncio.sleep(5)
+
+    async def _wait_for_work(self):
+        row = await self.db.fetchone("SELECT MIN(next_attempt_at) FROM notifications")
+        timeout = max(row[0] - time.time(), 0) if row and row[0] is not None else None
+        if self.poll_interval is not None:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # Даем накопиться пачке событий, чтобы отправить их одной сводкой
+        await asyncio.sleep(self.coalesce_window)
+
+    # Отправляет все готовые уведомления; возвращает False, если отправлять нечего
+    async def _deliver_ready(self):
+        rows = await self.db.fetchall(
+            "SELECT id, chat_id, text, attempts FROM notifications WHERE next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), self.batch_size)
+        )
+        if not rows:
+            return False
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+        for chat_id, chat_rows in by_chat.items():
+            for digest_rows in self._split_digests(chat_rows):
+                await self._send(chat_id, digest_rows)
+        return True
+
+    # Делит уведомления на сводки, каждая не длиннее лимита Telegram
+    def _split_digests(self, rows):
+        digests, current, length = [], [], 0
+        for row in rows:
+            added = len(row[2]) + 2
+            if current and length + added > MAX_MESSAGE_LENGTH - 100:
+                digests.append(current)
+                current, length = [], 0
+            current.append(row)
+            length += added
+        if current:
+            digests.append(current)
+        return digests
+
+    async def _send(self, chat_id: str, rows):
+        ids = [row[0] for row in rows]
+        text = "\n\n".join(row[2] for row in rows)
+        if len(rows) > 1:
+            text = f"🗂 *Сводка уведомлений ({len(rows)})*\n\n" + text
+        parse_mode = "Markdown"
+        # Обрезка может разрезать разметку, поэтому слишком длинное уведомление уходит простым текстом
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text, parse_mode = text[:MAX_MESSAGE_LENGTH], None
+        while True:
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                break
+            except TelegramRetryAfter as e:
+                logging.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой уведомления")
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if len(rows) > 1:
+                    logging.warning(f"Сводка уведомлений не принята ({e}), отправка по одному")
+                    for row in rows:
+                        await self._send(chat_id, [row])
+                    return
+                if parse_mode is not None:
+                    logging.warning(f"Уведомление не принято ({e}), отправка без разметки")
+                    parse_mode = None
+                    continue
+                await self._drop(rows, e)
+                return
+            except Exception as e:
+                await self._reschedule(rows, e)
+                return
+        placeholders = ", ".join("?" * len(ids))
+        await self.db.execute(f"DELETE FROM notifications WHERE id IN ({placeholders})", ids)
+        self.sent += len(ids)
+
+    async def _drop(self, rows, error: Exception):
+        ids = [row[0] for row in rows]
+        self.failed += len(ids)
+        logging.error(f"Уведомление не может быть отправлено и удалено: {error}")
+        placeholders = ", ".join("?" * len(ids))
+        await self.db.execute(f"DELETE FROM notifications WHERE id IN ({placeholders})", ids)
+
+    async def _reschedule(self, rows, error: Exception):
+        now = time.time()
+        retry, dropped = [], []
+        for row_id, _, _, attempts in rows:
+            if attempts + 1 >= self.max_attempts:
+                dropped.append((row_id,))
+            else:
+                retry.append((attempts + 1, now + min(2 ** attempts * 5, self.max_backoff), row_id))
+        logging.error(f"Не удалось отправить уведомление в чат: {error}")
+        if dropped:
+            self.failed += len(dropped)
+            logging.error(f"Уведомления удалены после {self.max_attempts} попыток: {len(dropped)}")
+
+        def update(conn):
+            conn.executemany("UPDATE notifications SET attempts = ?, next_attempt_at = ? WHERE id = ?", retry)
+            conn.executemany("DELETE FROM notifications WHERE id = ?", dropped)
+
+        await self.db.transaction(update)
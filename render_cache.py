@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+
+# Кэш готовых текстов отчетов и клавиатур. Каждая запись помнит версию данных, при которой
+# она построена; любая запись бронирований увеличивает версию (bump), и старые записи перестают
+# выдаваться без обхода всего кэша. Статические записи (static=True) от версии данных не зависят —
+# все, от чего они зависят (например, версию каталога), нужно включать в ключ
+class RenderCache:
+    def __init__(self, max_entries: int = 2000):
+        self.max_entries = max_entries
+        self.version = 0
+        self._entries = OrderedDict()  # {ключ: (версия или None, значение)}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def bump(self):
+        self.version += 1
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] not in (None, self.version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value, static: bool = False):
+        self._store(key, None if static else self.version, value)
+
+    # Значение из кэша или результат render(), который сразу кэшируется
+    async def get_or_render(self, key, render, static: bool = False):
+        value = self.get(key)
+        if value is None:
+            # Версия может измениться, пока render() ждет базу: такой результат сразу устареет
+            version = self.version
+            value = await render()
+            if value is not None:
+                self._store(key, None if static else version, value)
+        return value
+
+    def _store(self, key, version, value):
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
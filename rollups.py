@@ -0,0 +1,83 @@
+import calendar
+
+from availability import date_range
+
+
+# Сводные таблицы по завершенным арендам. Обновляются при переносе броней в архив,
+# поэтому отчетам не нужно заново агрегировать весь архив:
+#   rollup_item_month — сколько единиц оборудования было в аренде по дням (единицы × дни) за месяц
+#   rollup_month — количество броней и выручка по месяцу начала аренды
+#   rollup_customer — количество броней и выручка по пользователям
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS rollup_item_month (
+                    month TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    unit_days INTEGER NOT NULL,
+                    PRIMARY KEY (month, item)) WITHOUT ROWID''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS rollup_month (
+                    month TEXT PRIMARY KEY,
+                    bookings INTEGER NOT NULL,
+                    revenue INTEGER NOT NULL)''')
+    conn.execute('''CREATE TABLE IF NOT EXISTS rollup_customer (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    bookings INTEGER NOT NULL,
+                    revenue INTEGER NOT NULL,
+                    last_date TEXT)''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_customer_revenue ON rollup_customer (revenue)")
+
+
+def clear(conn):
+    for table in ("rollup_item_month", "rollup_month", "rollup_customer"):
+        conn.execute(f"DELETE FROM {table}")
+
+
+# Добавляет в сводные таблицы завершенные брони: [(user_id, username, date, end_date, price, {название: количество})]
+def add_bookings(conn, bookings):
+    unit_days, months, customers = {}, {}, {}
+    for user_id, username, date, end_date, price, items in bookings:
+        price = price or 0
+        for day in date_range(date, end_date):
+            for item, quantity in items.items():
+                key = (day[:7], item)
+                unit_days[key] = unit_days.get(key, 0) + quantity
+        month = months.setdefault(date[:7], [0, 0])
+        month[0] += 1
+        month[1] += price
+        customer = customers.setdefault(user_id, [username, 0, 0, date])
+        customer[0] = username or customer[0]
+        customer[1] += 1
+        customer[2] += price
+        customer[3] = max(customer[3], end_date or date)
+
+    conn.executemany(
+        "INSERT INTO rollup_item_month (month, item, unit_days) VALUES (?, ?, ?) "
+        "ON CONFLICT (month, item) DO UPDATE SET unit_days = unit_days + excluded.unit_days",
+        [(month, item, value) for (month, item), value in unit_days.items()]
+    )
+    conn.executemany(
+        "INSERT INTO rollup_month (month, bookings, revenue) VALUES (?, ?, ?) "
+        "ON CONFLICT (month) DO UPDATE SET bookings = bookings + excluded.bookings, revenue = revenue + excluded.revenue",
+        [(month, count, revenue) for month, (count, revenue) in months.items()]
+    )
+    conn.executemany(
+        "INSERT INTO rollup_customer (user_id, username, bookings, revenue, last_date) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (user_id) DO UPDATE SET username = COALESCE(excluded.username, username), "
+        "bookings = bookings + excluded.bookings, revenue = revenue + excluded.revenue, "
+        "last_date = MAX(last_date, excluded.last_date)",
+        [(user_id, *values) for user_id, values in customers.items()]
+    )
+
+
+# Загрузка оборудования за месяц: {название: доля занятых единицо-дней от stock × дней в месяце}
+def utilization(unit_days: dict, catalog_items, month: str):
+    days = calendar.monthrange(int(month[:4]), int(month[5:]))[1]
+    items, categories = {}, {}
+    for catalog_item in catalog_items:
+        used = unit_days.get(catalog_item.name, 0)
+        capacity = catalog_item.stock * days
+        items[catalog_item.name] = used / capacity if capacity else 0.0
+        category = categories.setdefault(catalog_item.category, [0, 0])
+        category[0] += used
+        category[1] += capacity
+    return items, {name: used / capacity if capacity else 0.0 for name, (used, capacity) in categories.items()}
@@ -0,0 +1,223 @@
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+
+from aiohttp import ClientSession, ClientTimeout, web
+from dotenv import load_dotenv
+
+import migrations
+from db import Database
+from webhook import SECRET_HEADER
+
+# Запуск нескольких воркеров бота (bot.py) на одной базе. Supervisor сам принимает апдейты
+# (вебхук Telegram при BOT_MODE=webhook или long polling) и передает каждый воркеру user_id % WORKERS
+# через его локальный вебхук. Апдейты одного пользователя всегда попадают в один воркер и по порядку,
+# поэтому состояние FSM и кэши воркера остаются согласованными, а конкуренция за остатки на одну дату
+# решается транзакциями в общей базе. Упавший воркер перезапускается.
+# Пример: WORKERS=4 python supervisor.py
+
+TELEGRAM_API = "https://api.telegram.org"
+ALLOWED_UPDATES = ["message", "callback_query"]
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+WORKER_PATH = "/webhook"
+
+
+# Пользователь апдейта: from у сообщений и нажатий, user или chat у остальных типов
+def update_user_id(update: dict):
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat")
+            if isinstance(user, dict) and "id" in user:
+                return user["id"]
+    return 0
+
+
+class Worker:
+    def __init__(self, index: int, port: int, env: dict, max_queue: int = 1000):
+        self.index = index
+        self.url = f"http://127.0.0.1:{port}{WORKER_PATH}"
+        self.env = env
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.process = None
+
+    # Процесс воркера; если он завершился сам, запускаем заново
+    async def run(self, stop: asyncio.Event):
+        while not stop.is_set():
+            # Своя сессия: Ctrl+C в терминале не доходит до воркеров, их останавливает supervisor
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, BOT_SCRIPT, env=self.env, start_new_session=True
+            )
+            code = await self.process.wait()
+            if stop.is_set():
+                break
+            logging.error(f"Воркер {self.index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1)
+
+    # Передача апдейтов воркеру по одному в порядке поступления. Пока воркер запускается
+    # или перезапускается, апдейт повторяется с растущей паузой
+    async def forward(self, session: ClientSession, secret: str):
+        headers = {SECRET_HEADER: secret, "Content-Type": "application/json"}
+        while True:
+            body = await self.queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    async with session.post(self.url, data=body, headers=headers) as response:
+                        if response.status < 500:
+                            if response.status != 200:
+                                logging.warning(f"Воркер {self.index} отклонил апдейт: HTTP {response.status}")
+                            break
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    pass
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+            self.queue.task_done()
+
+    def terminate(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def call_api(session: ClientSession, token: str, method: str, **params):
+    timeout = ClientTimeout(total=params.get("timeout", 0) + 10)
+    async with session.post(f"{TELEGRAM_API}/bot{token}/{method}", json=params, timeout=timeout) as response:
+        result = await response.json()
+    if not result.get("ok"):
+        raise RuntimeError(f"{method}: {result.get('description')}")
+    return result["result"]
+
+
+# Long polling: апдейты передаются дальше в исходном виде
+async def poll_updates(session: ClientSession, token: str, dispatch):
+    offset = 0
+    while True:
+        try:
+            updates = await call_api(session, token, "getUpdates", offset=offset, timeout=30,
+                                     allowed_updates=ALLOWED_UPDATES)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка при получении апдейтов: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            offset = update["update_id"] + 1
+            await dispatch(update)
+
+
+def create_front_app(dispatch, path: str = "/webhook", secret: str = None):
+    async def handle(request: web.Request):
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        # Если очередь воркера заполнена, ответ задерживается и Telegram притормаживает отправку
+        await dispatch(update, body)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+# Обычные миграции выполняются один раз до запуска воркеров, чтобы они не применяли их одновременно.
+# Онлайн-миграции затем в фоне выполняет первый воркер
+async def prepare_database(path: str):
+    db = Database(path)
+    await db.connect()
+    try:
+        await migrations.migrate(db)
+    finally:
+        await db.close()
+
+
+async def main():
+    token = os.getenv("TOKEN")
+    count = int(os.getenv("WORKERS", os.cpu_count() or 1))
+    base_port = int(os.getenv("WORKER_BASE_PORT", 8100))
+    await prepare_database(os.getenv("DB_PATH", "bookings.db"))
+
+    # Воркеры слушают только локальный адрес и принимают апдейты с внутренним секретом
+    internal_secret = secrets.token_urlsafe(32)
+    workers = []
+    for index in range(count):
+        env = dict(
+            os.environ,
+            BOT_MODE="webhook",
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(base_port + index),
+            WEBHOOK_PATH=WORKER_PATH,
+            WEBHOOK_SECRET=internal_secret,
+            WEBHOOK_URL="",
+            WORKER_ID=str(index),
+            WORKERS=str(count),
+        )
+        if os.getenv("METRICS_PORT"):
+            env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + index)
+        workers.append(Worker(index, base_port + index, env))
+
+    async def dispatch(update: dict, body: bytes = None):
+        worker = workers[update_user_id(update) % count]
+        await worker.queue.put(body or json.dumps(update).encode("utf-8"))
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    async with ClientSession() as session:
+        runs = [asyncio.create_task(worker.run(stop)) for worker in workers]
+        senders = [asyncio.create_task(worker.forward(session, internal_secret)) for worker in workers]
+        runner, poller = None, None
+        if os.getenv("BOT_MODE", "polling") == "webhook":
+            path = os.getenv("WEBHOOK_PATH", "/webhook")
+            host, port = os.getenv("WEBHOOK_HOST", "0.0.0.0"), int(os.getenv("WEBHOOK_PORT", 8080))
+            runner = web.AppRunner(create_front_app(dispatch, path, os.getenv("WEBHOOK_SECRET")))
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            if os.getenv("WEBHOOK_URL"):
+                await call_api(session, token, "setWebhook", url=os.getenv("WEBHOOK_URL").rstrip("/") + path,
+                               secret_token=os.getenv("WEBHOOK_SECRET"), allowed_updates=ALLOWED_UPDATES)
+            logging.info(f"Supervisor слушает {host}:{port}{path}, воркеров: {count}")
+        else:
+            poller = asyncio.create_task(poll_updates(session, token, dispatch))
+            logging.info(f"Supervisor получает апдейты через long polling, воркеров: {count}")
+
+        await stop.wait()
+        logging.info("Остановка воркеров")
+        if runner is not None:
+            await runner.cleanup()
+        if poller is not None:
+            poller.cancel()
+        # Успеваем передать уже принятые апдейты, затем воркеры сами дорабатывают начатое
+        try:
+            await asyncio.wait_for(asyncio.gather(*(worker.queue.join() for worker in workers)), 10)
+        except asyncio.TimeoutError:
+            logging.warning("Не все апдейты переданы воркерам до остановки")
+        for task in senders:
+            task.cancel()
+        for worker in workers:
+            worker.terminate()
+        await asyncio.gather(*runs)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        logging.error(f"Ошибка: {e}")
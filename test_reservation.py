@@ -0,0 +1,93 @@
+import asyncio
+import os
+import random
+import tempfile
+import unittest
+
+import migrations
+from bot import ReservationConflict, reserve_booking
+from catalog import Catalog
+from db import Database
+
+
+# Стресс-тест подтверждения брони: много одновременных подтверждений на одну дату и позицию.
+# Запуск: python -m unittest test_reservation (или pytest)
+class ConcurrentReservationTest(unittest.IsolatedAsyncioTestCase):
+    DATE = "2030-06-01"
+    END_DATE = "2030-06-03"
+
+    async def asyncSetUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, "bookings.db")
+        self.db = Database(self.path)
+        await self.db.connect()
+        await migrations.migrate(self.db)
+        self.catalog = Catalog()
+        await self.catalog.load(self.db)
+        self.item = max(self.catalog.by_id.values(), key=lambda item: item.stock)
+        self.databases = [self.db]
+
+    async def asyncTearDown(self):
+        for db in self.databases:
+            await db.close()
+        self.tempdir.cleanup()
+
+    # Одно подтверждение; возвращает забронированное количество или исключение
+    async def confirm(self, db: Database, user_id: int, quantity: int):
+        items = {self.item.name: quantity}
+        try:
+            await db.transaction(lambda conn: reserve_booking(
+                conn, self.catalog, user_id, f"user{user_id}", self.DATE, self.END_DATE, items,
+                f"{self.item.name} x{quantity}", 0
+            ))
+        except ReservationConflict as e:
+            return e
+        return quantity
+
+    async def check_totals(self, results):
+        booked = sum(result for result in results if isinstance(result, int))
+        conflicts = [result for result in results if isinstance(result, ReservationConflict)]
+        self.assertEqual(len(conflicts) + sum(isinstance(result, int) for result in results), len(results))
+        self.assertLessEqual(booked, self.item.stock)
+        for conflict in conflicts:
+            self.assertIn(self.item.name, conflict.shortages)
+
+        # Брони, позиции и счетчики по дням сходятся между собой
+        stored = (await self.db.fetchone(
+            "SELECT COALESCE(SUM(quantity), 0) FROM booking_items WHERE item = ?", (self.item.name,)
+        ))[0]
+        self.assertEqual(stored, booked)
+        usage = await self.db.fetchall(
+            "SELECT date, quantity FROM item_day_usage WHERE item = ? ORDER BY date", (self.item.name,)
+        )
+        self.assertEqual(usage, [(day, booked) for day in ("2030-06-01", "2030-06-02", "2030-06-03")])
+        return booked
+
+    async def test_single_unit_confirmations(self):
+        users = self.item.stock * 20
+        results = await asyncio.gather(*(self.confirm(self.db, user_id, 1) for user_id in range(users)))
+        booked = await self.check_totals(results)
+        self.assertEqual(booked, self.item.stock)
+        self.assertEqual(sum(isinstance(result, ReservationConflict) for result in results), users - self.item.stock)
+
+    async def test_mixed_quantities(self):
+        rng = random.Random(1)
+        results = await asyncio.gather(*(
+            self.confirm(self.db, user_id, rng.randint(1, max(self.item.stock, 1))) for user_id in range(200)
+        ))
+        await self.check_totals(results)
+
+    # Два соединения-писателя на один файл, как у воркеров supervisor.py
+    async def test_two_writers(self):
+        other = Database(self.path)
+        await other.connect()
+        self.databases.append(other)
+        results = await asyncio.gather(*(
+            self.confirm(self.databases[user_id % 2], user_id, 1) for user_id in range(self.item.stock * 20)
+        ))
+        booked = await self.check_totals(results)
+        self.assertEqual(booked, self.item.stock)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+
+
+# Ограничение частоты запросов от одного пользователя (token bucket).
+# Настройки для конкретного обработчика задаются флагом:
+#   @dp.message(..., flags={"throttling": {"rate": 0.5, "burst": 2}})
+#   @dp.message(..., flags={"throttling": False})  — без ограничения
+# Флаг "key" позволяет нескольким обработчикам делить одно ведро.
+# Повторное нажатие той же кнопки, пока первое еще обрабатывается, отбрасывается сразу
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rate: float = 2, burst: int = 5, max_buckets: int = 10000):
+        self.rate = rate  # токенов в секунду
+        self.burst = burst  # размер ведра
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()  # {(user_id, ключ): [токены, время]}
+        self._in_flight = set()
+        self.dropped = {}  # {обработчик: сколько апдейтов отброшено}
+
+    async def __call__(self, handler, event, data):
+        settings = get_flag(data, "throttling", default={})
+        user = data.get("event_from_user")
+        if settings is False or user is None:
+            return await handler(event, data)
+
+        handler_name = data["handler"].callback.__name__
+        payload = event.text if isinstance(event, Message) else event.data if isinstance(event, CallbackQuery) else None
+        press = (user.id, handler_name, payload)
+        if press in self._in_flight or not self._take_token(user.id, settings.get("key", handler_name), settings):
+            self.dropped[handler_name] = self.dropped.get(handler_name, 0) + 1
+            if isinstance(event, CallbackQuery):
+                await event.answer("Слишком часто, подождите немного.")
+            return None
+
+        self._in_flight.add(press)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(press)
+
+    def _take_token(self, user_id: int, key: str, settings: dict):
+        rate = settings.get("rate", self.rate)
+        burst = settings.get("burst", self.burst)
+        now = time.monotonic()
+        bucket_key = (user_id, key)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = [burst, now]
+            self._buckets[bucket_key] = bucket
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(bucket_key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def stats(self):
+        return {"buckets": len(self._buckets), "in_flight": len(self._in_flight),
+                "dropped_total": sum(self.dropped.values()), "dropped": dict(self.dropped)}
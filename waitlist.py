@@ -0,0 +1,146 @@
+import datetime
+import time
+from typing import NamedTuple
+
+import availability
+
+
+# Лист ожидания: пользователи встают в очередь на оборудование, которого нет на нужные даты.
+# Когда бронь отменяют, освободившееся оборудование по порядку очереди удерживается за первыми
+# подходящими заявками на hold_seconds. Удержание учитывается в счетчиках item_day_usage так же,
+# как бронь, поэтому никто другой занять его не может. Заявка с held_until — удержание, без — ожидание.
+# Функции синхронные и выполняются в транзакции писателя. Таблицу создает миграция 4
+def create_schema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS waitlist (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    username TEXT,
+                    date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    item TEXT NOT NULL,
+                    quantity INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    held_until REAL)''')
+    # Подбор заявок при отмене брони: позиция и диапазон дат по индексу, только ожидающие заявки
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_waitlist_item_date ON waitlist (item, date) WHERE held_until IS NULL"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_waitlist_held_until ON waitlist (held_until) WHERE held_until IS NOT NULL"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waitlist_user ON waitlist (user_id)")
+
+
+class Entry(NamedTuple):
+    id: int
+    user_id: int
+    date: str
+    end_date: str
+    item: str
+    quantity: int
+    held_until: float  # None — заявка еще ждет
+
+
+ENTRY_COLUMNS = "id, user_id, date, end_date, item, quantity, held_until"
+
+
+def add(conn, user_id: int, username: str, date: str, end_date: str, item: str, quantity: int):
+    entry_id = conn.execute(
+        "INSERT INTO waitlist (user_id, username, date, end_date, item, quantity, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (user_id, username, date, end_date, item, quantity, time.time())
+    ).lastrowid
+    return Entry(entry_id, user_id, date, end_date, item, quantity, None)
+
+
+def user_entries(conn, user_id: int):
+    return [Entry(*row) for row in conn.execute(
+        f"SELECT {ENTRY_COLUMNS} FROM waitlist WHERE user_id = ? ORDER BY date, id", (user_id,)
+    ).fetchall()]
+
+
+# Место заявки в очереди среди ожидающих заявок на ту же позицию с пересекающимся периодом
+def position(conn, entry: Entry, max_days: int = 31):
+    return conn.execute(
+        "SELECT COUNT(*) FROM waitlist WHERE item = ? AND held_until IS NULL AND date BETWEEN ? AND ? "
+        "AND end_date >= ? AND id <= ?",
+        (entry.item, _shift(entry.date, 1 - max_days), entry.end_date, entry.date, entry.id)
+    ).fetchone()[0]
+
+
+def _shift(date: str, days: int):
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+# Раздает освободившееся оборудование {название: количество} за период date — end_date
+# ожидающим заявкам в порядке очереди. Заявка получает удержание, если на весь ее период хватает
+# свободных единиц. Просматривается не больше max_checks заявок на позицию, поэтому отмена
+# остается дешевой даже при длинной очереди. Возвращает новые удержания
+def allocate(conn, catalog, date: str, end_date: str, items: dict, hold_seconds: float,
+             max_days: int = 31, max_checks: int = 20):
+    held_until = time.time() + hold_seconds
+    holds = []
+    for item in items:
+        catalog_item = catalog.get(item)
+        if catalog_item is None:
+            continue
+        # Заявки не длиннее max_days, поэтому начало пересекающейся заявки — не раньше date - (max_days - 1)
+        rows = conn.execute(
+            f"SELECT {ENTRY_COLUMNS} FROM waitlist WHERE item = ? AND held_until IS NULL "
+            "AND date BETWEEN ? AND ? AND end_date >= ? ORDER BY id LIMIT ?",
+            (item, _shift(date, 1 - max_days), end_date, date, max_checks)
+        ).fetchall()
+        for row in rows:
+            entry = Entry(*row)
+            booked = availability.range_usage(conn, entry.date, entry.end_date, [item]).get(item, 0)
+            if catalog_item.stock - booked < entry.quantity:
+                continue
+            availability.add_usage(conn, entry.date, entry.end_date, {item: entry.quantity})
+            conn.execute("UPDATE waitlist SET held_until = ? WHERE id = ?", (held_until, entry.id))
+            holds.append(entry._replace(held_until=held_until))
+    return holds
+
+
+# Удаляет заявку пользователя; если она была удержанием, возвращает оборудование в счетчики.
+# Возвращает удаленную заявку или None
+def remove(conn, entry_id: int, user_id: int = None):
+    sql = f"SELECT {ENTRY_COLUMNS} FROM waitlist WHERE id = ?"
+    params = [entry_id]
+    if user_id is not None:
+        sql += " AND user_id = ?"
+        params.append(user_id)
+    row = conn.execute(sql, params).fetchone()
+    if row is None:
+        return None
+    entry = Entry(*row)
+    if entry.held_until is not None:
+        availability.remove_usage(conn, entry.date, entry.end_date, {entry.item: entry.quantity})
+    conn.execute("DELETE FROM waitlist WHERE id = ?", (entry_id,))
+    return entry
+
+
+# Забирает действующее удержание для оформления брони. Счетчики занятости уже учитывают его,
+# поэтому вызывающий записывает бронь без повторного add_usage
+def take(conn, entry_id: int, user_id: int):
+    row = conn.execute(
+        f"SELECT {ENTRY_COLUMNS} FROM waitlist WHERE id = ? AND user_id = ? AND held_until > ?",
+        (entry_id, user_id, time.time())
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute("DELETE FROM waitlist WHERE id = ?", (entry_id,))
+    return Entry(*row)
+
+
+# Снимает просроченные удержания; возвращает их
+def expire(conn, now: float = None):
+    rows = conn.execute(
+        f"SELECT {ENTRY_COLUMNS} FROM waitlist WHERE held_until IS NOT NULL AND held_until <= ?",
+        (time.time() if now is None else now,)
+    ).fetchall()
+    return [remove(conn, row[0]) for row in rows]
+
+
+# Ожидающие заявки на прошедшие даты больше не нужны
+def drop_before(conn, date: str):
+    conn.execute("DELETE FROM waitlist WHERE end_date < ? AND held_until IS NULL", (date,))
@@ -0,0 +1,92 @@
+import asyncio
+import hmac
+import logging
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+# Прием апдейтов по вебхуку: проверяем секрет, сразу отвечаем 200 и обрабатываем апдейт в фоне.
+# Одновременно обрабатывается не больше max_concurrency апдейтов; когда все слоты заняты,
+# ответ задерживается и Telegram сам притормаживает отправку
+class WebhookHandler:
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str = None, max_concurrency: int = 100):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._tasks = set()
+
+    async def __call__(self, request: web.Request):
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.warning(f"Некорректный апдейт: {e}")
+            return web.Response(status=400)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке апдейта {update.update_id}: {e}")
+        finally:
+            self._slots.release()
+
+    # Дожидаемся апдейтов, которые уже в обработке
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_webhook_app(dp: Dispatcher, bot: Bot, path: str = "/webhook", secret: str = None,
+                       max_concurrency: int = 100):
+    handler = WebhookHandler(dp, bot, secret, max_concurrency)
+    app = web.Application()
+    app.router.add_post(path, handler)
+    app["webhook_handler"] = handler
+    return app
+
+
+# Запуск бота в режиме вебхука. Хуки startup/shutdown диспетчера те же, что и при polling.
+# Если задан url, вебхук регистрируется в Telegram (url + path)
+async def run_webhook(dp: Dispatcher, bot: Bot, host: str = "0.0.0.0", port: int = 8080,
+                      path: str = "/webhook", secret: str = None, url: str = None,
+                      max_concurrency: int = 100):
+    app = create_webhook_app(dp, bot, path, secret, max_concurrency)
+    runner = web.AppRunner(app)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await dp.emit_startup(bot=bot)
+    try:
+        if url:
+            await bot.set_webhook(
+                url.rstrip("/") + path,
+                secret_token=secret,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        logging.info(f"Вебхук слушает {host}:{port}{path}")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await app["webhook_handler"].drain()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()